@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Event-driven Messaging System Server on asyncio"""
+
+import sys
+import signal
+import asyncio
+import argparse
+import importlib
+import logger
+import options
+import server_utils as utils
+from framing import FrameReader
+from metrics import stats
+from registry import ClientRegistry
+from pending import PendingTable
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#===================================CLASSES===================================#
+
+# A client connection. Incoming bytes are written straight into its frame
+# reader's buffer and every complete frame goes through the same processing
+# functions as the select based server.
+#
+# Backpressure uses the transport's write buffer limits: while they are
+# exceeded the client is congested and, if it is throttled, not read from.
+# Clients paused until another one drains are resumed from its
+# resume_writing.
+#
+# Frames sent to a client while the loop runs a callback are gathered and
+# written together with writelines once it is done, instead of one transport
+# write each. Gathered bytes count toward the high water mark along with the
+# transport's buffer, so the client is congested as soon as a callback has
+# sent it more than it can take.
+class ClientProtocol(asyncio.BufferedProtocol):
+  def __init__(self, state, high_water, low_water):
+    self.state = state
+    self.reader = FrameReader(None, views=True)
+    self.transport = None
+    self.high_water = high_water
+    self.low_water = low_water
+    self.congested = False
+    self.writing_paused = False  # Between pause_writing and resume_writing
+    self.throttle = False
+    self.paused = False
+    self.blocked = []
+    self.caps = 0
+    self.closed = False
+    self.iov = []  # Frames sent in the current callback
+    self.gathered_bytes = 0  # And their size
+
+  def connection_made(self, transport):
+    self.transport = transport
+    transport.set_write_buffer_limits(self.high_water, self.low_water)
+    logger.log(logger.LOG, "connect", "Client {} is now connected.",
+               transport.get_extra_info("peername"))
+
+  def get_buffer(self, sizehint):
+    return self.reader.space()
+
+  def buffer_updated(self, nbytes):
+    self.reader.end += nbytes
+    stats.bytes_in += nbytes
+
+    for msg in self.reader.frames():
+      # Process received message according to its type
+      utils.process_msg(msg, self, *self.state)
+      if self.closed:
+        # Client has been killed while processing its messages
+        break
+    utils.drain_store(*self.state)
+    logger.flush()
+
+  def pause_writing(self):
+    self.writing_paused = True
+    self.congest()
+
+  def resume_writing(self):
+    self.writing_paused = False
+    self.congested = False
+    if self.throttle and not self.paused and not self.closed:
+      self.transport.resume_reading()
+    self.release()
+    # It can take what was kept for it while it was congested
+    utils.drain_store(*self.state)
+
+  def congest(self):
+    if not self.congested:
+      self.congested = True
+      if self.throttle:
+        self.transport.pause_reading()
+
+  def wait_for(self, other):
+    if not self.paused:
+      self.paused = True
+      self.transport.pause_reading()
+    other.blocked.append(self)
+
+  def resume(self):
+    if self.paused and not self.closed:
+      self.paused = False
+      if not (self.throttle and self.congested):
+        self.transport.resume_reading()
+
+  def release(self):
+    blocked = self.blocked
+    self.blocked = []
+    for client in blocked:
+      client.resume()
+
+  def connection_lost(self, exc):
+    if not self.closed:
+      # A client has closed the connection
+      utils.kill_client(self, "con_dead", *self.state)
+      logger.flush()
+
+  # Same interface the processing functions use on selector connections
+  def send(self, data):
+    if not self.closed:
+      if isinstance(data, memoryview):
+        # Transports may keep a reference to what they can't send at once,
+        # but views into the receive buffer are only valid until it refills
+        data = data.tobytes()
+      stats.bytes_out += len(data)
+      if not self.iov:
+        asyncio.get_event_loop().call_soon(self.write_gathered)
+      self.iov.append(data)
+      self.gathered_bytes += len(data)
+
+      if (self.transport.get_write_buffer_size() + self.gathered_bytes >=
+          self.high_water):
+        self.congest()
+
+  def sendv(self, buffers):
+    for data in buffers:
+      self.send(data)
+
+  def write_gathered(self):
+    if self.iov and not self.closed:
+      self.transport.writelines(self.iov)
+    self.iov = []
+    self.gathered_bytes = 0
+
+    if self.congested and not self.writing_paused and not self.closed:
+      # The transport took what congested it without pausing, so there will
+      # be no resume_writing
+      self.resume_writing()
+
+  # Close the transport once it has written what it was sent, or right away
+  # if it is congested, since a client that isn't reading would keep it open
+  def close(self):
+    if not self.closed:
+      self.write_gathered()
+      self.closed = True
+      if self.congested:
+        self.transport.abort()
+      else:
+        self.transport.close()
+      self.release()
+
+#===================================METHODS===================================#
+
+# Future resolved with the outcome of a delivery once it is completed
+def delivered(delivery):
+  future = asyncio.get_running_loop().create_future()
+  on_done = delivery.on_done
+
+  def done(delivery):
+    if on_done:
+      on_done(delivery)
+    if not future.done():
+      future.set_result(delivery.succeeded())
+
+  delivery.on_done = done
+  return future
+
+
+# Answer ERRO for messages whose exhibitors didn't acknowledge in time, and
+# forward again the kept ones among them. All deliveries share the same
+# timeout, so none can expire before the next wake.
+async def expire_pending(state):
+  pending = state[-1]
+
+  while True:
+    timeout = pending.next_timeout()
+    await asyncio.sleep(pending.timeout if timeout is None else timeout)
+    utils.expire_pending(*state)
+    utils.drain_store(*state)
+    logger.flush()
+
+
+# Write the server metrics every interval
+async def report_stats(state):
+  registry, pending = state[1:]
+
+  while True:
+    await asyncio.sleep(stats.next_timeout())
+    stats.report(registry, pending)
+
+
+# Send FLW to every client at once and wait for their OK concurrently
+async def shutdown(server, state):
+  server.close()
+
+  pending = state[-1]
+  deliveries = utils.announce_FLW(*state)
+  if deliveries:
+    await asyncio.wait([delivered(d) for d in deliveries],
+                       timeout=pending.timeout)
+
+  utils.kill_all(*state)
+  await server.wait_closed()
+  if utils.store is not None:
+    utils.store.close()
+  logger.close()
+
+
+async def serve(args):
+  loop = asyncio.get_running_loop()
+  # Connected clients and emitter/exhibitor pairs
+  registry = ClientRegistry(args.id_order == "lowest")
+  pending = PendingTable(args.ack_timeout)  # Deliveries waiting for an answer
+
+  # Arguments every processing function takes after the connection. There
+  # is no selector here.
+  state = (None, registry, pending)
+
+  def client():
+    return ClientProtocol(state, args.high_water, args.low_water)
+
+  server = await loop.create_server(client, "", args.port, 
+                                    reuse_address=True)
+  print("Server is now listening on port ", args.port, ".", sep="")
+
+  stop = asyncio.Event()
+  try:
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+  except NotImplementedError:
+    # Signal handlers can't be installed on this platform's loop
+    pass
+
+  tasks = [asyncio.ensure_future(expire_pending(state))]
+  if stats.next_timeout() is not None:
+    tasks.append(asyncio.ensure_future(report_stats(state)))
+  try:
+    await stop.wait()
+  finally:
+    for task in tasks:
+      task.cancel()
+    await shutdown(server, state)
+
+
+# Install the event loop policy named as module.Class, e.g. uvloop's
+def set_loop_policy(name):
+  module_name, class_name = name.rsplit(".", 1)
+  policy = getattr(importlib.import_module(module_name), class_name)
+  asyncio.set_event_loop_policy(policy())
+
+#====================================MAIN=====================================#
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  options.add_server_options(parser)
+  parser.add_argument("--loop-policy", metavar="MODULE.CLASS",
+                      help="event loop policy to run on, e.g. "
+                           "uvloop.EventLoopPolicy")
+  args = parser.parse_args()
+  options.configure(parser, args)
+
+  if args.loop_policy:
+    set_loop_policy(args.loop_policy)
+
+  asyncio.run(serve(args))
+  sys.exit()
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Load Generator and Benchmark"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import random
+import shlex
+import socket
+import struct
+import argparse
+import platform
+import subprocess
+import codec
+from framing import FrameReader
+from connection import selectors, retry_errors
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+serv_id = (2 ** 16) - 1  # Server id
+
+clock = getattr(time, "perf_counter", time.time)
+stamp = struct.Struct("!d")  # Send time carried at the start of every MSG
+
+#===================================CLASSES===================================#
+
+# A synthetic client. Connects and runs the OI handshake synchronously, then
+# switches to non-blocking mode to be driven by the benchmark loop.
+class Client(object):
+  def __init__(self, addr, oi_id):
+    self.s = socket.create_connection(addr)
+    self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.reader = FrameReader(self.s)
+    self.s.sendall(codec.create_msg('OI', oi_id, serv_id, 0)[0])
+
+    msg = self.reader.receive()
+    if msg is None or msg['type'] != codec.OK:
+      raise RuntimeError("Server refused OI " + str(oi_id))
+    self.id = msg['dest_id']
+
+    self.s.setblocking(False)
+    self.outbound = bytearray()
+    self.seq_id = 1
+    self.outstanding = {}  # msg_id -> (send time, kind), emitters only
+
+  # Send data, keeping what the socket can't take for write readiness
+  def send(self, data):
+    if not self.outbound:
+      try:
+        sent = self.s.send(data)
+      except socket.error as e:
+        if e.errno not in retry_errors:
+          raise
+        sent = 0
+      data = memoryview(data)[sent:]
+    self.outbound += data
+
+  # Write pending data. Returns True if everything has been written.
+  def flush(self):
+    if self.outbound:
+      try:
+        sent = self.s.send(self.outbound)
+      except socket.error as e:
+        if e.errno not in retry_errors:
+          raise
+        sent = 0
+      del self.outbound[:sent]
+    return not self.outbound
+
+  # Read whatever arrived. Returns False if the server closed the connection.
+  def read(self):
+    try:
+      return self.reader.fill() > 0
+    except socket.error as e:
+      return e.errno in retry_errors
+
+  # Next message id, wrapping around to 1 like the clients do
+  def next_id(self):
+    msg_id = self.seq_id
+    self.seq_id = codec.following_msg_id(self.seq_id)
+    return msg_id
+
+
+# Everything measured during a run
+class Results(object):
+  def __init__(self):
+    self.sent = {"unicast": 0, "broadcast": 0, "creq": 0}
+    self.ok = 0
+    self.erro = 0
+    self.delivered = 0  # MSG frames received by exhibitors
+    self.clists = 0  # CLIST frames received by exhibitors
+    self.ack_latency = []  # Emitter send until its OK/ERRO, seconds
+    self.delivery_latency = []  # Emitter send until exhibitor receives it
+
+#===================================METHODS===================================#
+
+# Value at quantile q of sorted samples, in milliseconds
+def percentile(samples, q):
+  if not samples:
+    return None
+  return samples[int(q * (len(samples) - 1))] * 1000.0
+
+
+# Summary of a list of latencies, in milliseconds
+def latency_summary(samples):
+  samples.sort()
+  return {
+    "count": len(samples),
+    "mean_ms": sum(samples) * 1000.0 / len(samples) if samples else None,
+    "p50_ms": percentile(samples, 0.50),
+    "p99_ms": percentile(samples, 0.99),
+    "p999_ms": percentile(samples, 0.999),
+    "max_ms": samples[-1] * 1000.0 if samples else None,
+  }
+
+
+# CPU seconds used and resident memory(current and peak, in KiB) of a process
+def process_usage(pid):
+  try:
+    with open("/proc/%d/stat" % pid) as f:
+      fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+
+    rss = peak = None
+    with open("/proc/%d/status" % pid) as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          rss = int(line.split()[1])
+        elif line.startswith("VmHWM:"):
+          peak = int(line.split()[1])
+    return {"cpu_s": cpu, "rss_kib": rss, "peak_rss_kib": peak}
+  except (IOError, OSError, ValueError):
+    pass
+
+  try:
+    import psutil
+  except ImportError:
+    # No way to measure the server on this platform
+    return None
+
+  proc = psutil.Process(pid)
+  times = proc.cpu_times()
+  return {"cpu_s": times.user + times.system,
+          "rss_kib": proc.memory_info().rss // 1024, "peak_rss_kib": None}
+
+
+# Start a server on the given port and wait until it accepts connections
+def spawn_server(script, port, extra):
+  cmd = [sys.executable, script, str(port)] + shlex.split(extra)
+  with open(os.devnull, "w") as devnull:
+    # The server has a copy of the descriptor of its own
+    proc = subprocess.Popen(cmd, stdout=devnull, stderr=subprocess.STDOUT)
+
+  deadline = time.time() + 10
+  while time.time() < deadline:
+    try:
+      socket.create_connection(("127.0.0.1", port)).close()
+      return proc
+    except socket.error:
+      if proc.poll() is not None:
+        break
+      time.sleep(0.05)
+
+  proc.kill()
+  sys.exit("Server didn't start.")
+
+
+# Parse a mix such as "unicast=8,broadcast=1,creq=1" into cumulative weights
+def parse_mix(text):
+  weights = []
+  total = 0.0
+  for part in text.split(","):
+    kind, weight = part.split("=")
+    if kind not in ("unicast", "broadcast", "creq"):
+      raise argparse.ArgumentTypeError("unknown message kind " + kind)
+    total += float(weight)
+    weights.append((total, kind))
+  return [(w / total, kind) for w, kind in weights]
+
+
+# Share of the messages of each kind in a mix, undoing the cumulative weights
+def mix_shares(mix):
+  shares = {}
+  previous = 0.0
+  for weight, kind in mix:
+    shares[kind] = round(shares.get(kind, 0) + weight - previous, 6)
+    previous = weight
+  return shares
+
+
+# Pick a message kind from cumulative weights
+def pick_kind(mix):
+  r = random.random()
+  for weight, kind in mix:
+    if r <= weight:
+      return kind
+  return mix[-1][1]
+
+
+# Send the next message of an emitter
+def send_next(emitter, mix, targets, payload_size, results):
+  kind = pick_kind(mix)
+  msg_id = emitter.next_id()
+  dest_id = 0 if kind == "broadcast" else random.choice(targets)
+
+  if kind == "creq":
+    msg = codec.create_msg('CREQ', emitter.id, dest_id, msg_id)[0]
+  else:
+    payload = bytearray(payload_size)
+    stamp.pack_into(payload, 0, clock())
+    msg = codec.create_msg('MSG', emitter.id, dest_id, msg_id, payload)[0]
+
+  emitter.outstanding[msg_id] = (clock(), kind)
+  emitter.send(msg)
+  results.sent[kind] += 1
+
+
+# Handle everything an exhibitor received, acknowledging it in one write
+def handle_exhibitor(exhibitor, results):
+  acks = bytearray()
+  now = clock()
+
+  for msg in exhibitor.reader.frames():
+    if msg['type'] == codec.MSG:
+      if len(msg['msg']) >= stamp.size:
+        results.delivery_latency.append(now - stamp.unpack_from(msg['msg'])[0])
+      results.delivered += 1
+    elif msg['type'] == codec.CLIST:
+      results.clists += 1
+    elif msg['type'] != codec.FLW:
+      continue
+
+    acks += codec.create_msg('OK', exhibitor.id, msg['orig_id'], msg['id'])[0]
+
+  if acks:
+    exhibitor.send(acks)
+
+
+# Match the answers an emitter received with its outstanding messages
+def handle_emitter(emitter, results):
+  now = clock()
+
+  for msg in emitter.reader.frames():
+    if msg['type'] == codec.FLW:
+      emitter.send(codec.create_msg('OK', emitter.id, serv_id, msg['id'])[0])
+      continue
+
+    sent = emitter.outstanding.pop(msg['id'], None)
+    if sent is None:
+      continue
+
+    results.ack_latency.append(now - sent[0])
+    if msg['type'] == codec.OK:
+      results.ok += 1
+    else:
+      results.erro += 1
+
+
+# Connect every synthetic client. Returns exhibitors, emitters and OI stats.
+def connect_clients(addr, args):
+  start = clock()
+
+  exhibitors = [Client(addr, 0) for _ in range(args.exhibitors)]
+  paired = min(args.paired, args.emitters, args.exhibitors)
+  emitters = [Client(addr, exhibitors[i].id) for i in range(paired)]
+  emitters += [Client(addr, 1) for _ in range(args.emitters - paired)]
+
+  elapsed = clock() - start
+  clients = len(exhibitors) + len(emitters)
+  oi = {"clients": clients, "paired": paired, "seconds": elapsed,
+        "per_second": clients / elapsed if elapsed else None}
+  return exhibitors, emitters, oi
+
+
+# Drive the load for the configured duration and collect the results
+def run(addr, args, mix):
+  exhibitors, emitters, oi = connect_clients(addr, args)
+
+  # Unicast targets: exhibitors and emitters paired with one
+  targets = [e.id for e in exhibitors] + [e.id for e in emitters[:oi["paired"]]]
+  if not targets:
+    sys.exit("There must be at least one exhibitor.")
+
+  sel = selectors.DefaultSelector()
+  for client in exhibitors:
+    sel.register(client.s, selectors.EVENT_READ, (client, handle_exhibitor))
+  for client in emitters:
+    sel.register(client.s, selectors.EVENT_READ, (client, handle_emitter))
+
+  results = Results()
+  start = clock()
+  stop_sending = start + args.duration
+  stop = stop_sending + args.drain
+  total_sent = 0
+  next_emitter = 0
+
+  while True:
+    now = clock()
+    if now >= stop:
+      break
+
+    if now < stop_sending and emitters:
+      # Send every message due by now, round robin over the emitters with
+      # room in their window
+      due = int((now - start) * args.rate) if args.rate else None
+      blocked = 0
+      while (due is None or total_sent < due) and blocked < len(emitters):
+        emitter = emitters[next_emitter]
+        next_emitter = (next_emitter + 1) % len(emitters)
+        if len(emitter.outstanding) >= args.window:
+          blocked += 1
+          continue
+        blocked = 0
+        send_next(emitter, mix, targets, args.size, results)
+        total_sent += 1
+    elif not any(e.outstanding for e in emitters):
+      # Everything has been answered
+      break
+
+    for client in exhibitors + emitters:
+      if client.outbound:
+        client.flush()
+
+    for key, mask in sel.select(0.001):
+      client, handle = key.data
+      if not client.read():
+        sel.unregister(client.s)
+        continue
+      handle(client, results)
+
+  elapsed = min(clock(), stop_sending) - start
+  for client in exhibitors + emitters:
+    client.s.close()
+  sel.close()
+
+  answered = results.ok + results.erro
+  return {
+    "duration_s": elapsed,
+    "connection_setup": oi,
+    "sent": results.sent,
+    "answered": {"ok": results.ok, "erro": results.erro,
+                 "missing": sum(results.sent.values()) - answered},
+    "received": {"msg": results.delivered, "clist": results.clists},
+    "throughput": {
+      "sent_per_s": sum(results.sent.values()) / elapsed,
+      "answered_per_s": answered / elapsed,
+      "delivered_per_s": (results.delivered + results.clists) / elapsed,
+    },
+    "ack_latency": latency_summary(results.ack_latency),
+    "delivery_latency": latency_summary(results.delivery_latency),
+  }
+
+#====================================MAIN=====================================#
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--connect", metavar="HOST:PORT",
+                      help="benchmark a running server instead of starting one")
+  parser.add_argument("--server-pid", type=int,
+                      help="pid of the running server, to measure its usage")
+  parser.add_argument("--server", default="server.py",
+                      help="server script to start (default: %(default)s)")
+  parser.add_argument("--server-args", default="",
+                      help="extra arguments for the started server")
+  parser.add_argument("--port", type=int, default=5555,
+                      help="port for the started server (default: %(default)s)")
+  parser.add_argument("--exhibitors", type=int, default=16,
+                      help="synthetic exhibitors (default: %(default)s)")
+  parser.add_argument("--emitters", type=int, default=16,
+                      help="synthetic emitters (default: %(default)s)")
+  parser.add_argument("--paired", type=int, default=0,
+                      help="how many emitters pair with an exhibitor "
+                           "(default: %(default)s)")
+  parser.add_argument("--mix", type=parse_mix, default="unicast=1",
+                      help="weights of unicast, broadcast and creq messages, "
+                           "e.g. unicast=8,broadcast=1,creq=1")
+  parser.add_argument("--rate", type=float, default=0,
+                      help="target messages per second over all emitters, 0 "
+                           "for as fast as the windows allow")
+  parser.add_argument("--window", type=int, default=8,
+                      help="messages each emitter may have in flight "
+                           "(default: %(default)s)")
+  parser.add_argument("--size", type=int, default=64,
+                      help="MSG payload bytes, at least 8 for the timestamp "
+                           "(default: %(default)s)")
+  parser.add_argument("--duration", type=float, default=10,
+                      help="seconds to send for (default: %(default)s)")
+  parser.add_argument("--drain", type=float, default=5,
+                      help="seconds to wait for answers after sending "
+                           "(default: %(default)s)")
+  parser.add_argument("--seed", type=int, help="random seed")
+  parser.add_argument("--output", default="bench_results.json",
+                      help="JSON file for the results (default: %(default)s)")
+  args = parser.parse_args()
+
+  random.seed(args.seed)
+  args.size = max(args.size, stamp.size)
+
+  server = None
+  if args.connect:
+    host, port = args.connect.split(":")
+    addr = (host, int(port))
+    pid = args.server_pid
+  else:
+    server = spawn_server(args.server, args.port, args.server_args)
+    addr = ("127.0.0.1", args.port)
+    pid = server.pid
+
+  try:
+    before = process_usage(pid) if pid else None
+    report = run(addr, args, args.mix)
+    after = process_usage(pid) if pid else None
+  finally:
+    if server:
+      server.kill()
+      server.wait()
+
+  if before and after:
+    report["server"] = {
+      "cpu_s": after["cpu_s"] - before["cpu_s"],
+      "cpu_percent": 100.0 * (after["cpu_s"] - before["cpu_s"]) /
+                     report["duration_s"],
+      "rss_kib": after["rss_kib"],
+      "peak_rss_kib": after["peak_rss_kib"],
+    }
+  else:
+    report["server"] = None
+
+  report["config"] = {
+    "server": args.connect or " ".join([args.server, args.server_args]),
+    "exhibitors": args.exhibitors, "emitters": args.emitters,
+    "paired": args.paired, "mix": mix_shares(args.mix),
+    "rate": args.rate, "window": args.window, "size": args.size,
+    "duration": args.duration, "python": platform.python_version(),
+  }
+
+  with open(args.output, "w") as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+
+  ack = report["ack_latency"]
+  print("Sent ", sum(report["sent"].values()), " messages in ",
+        round(report["duration_s"], 2), "s, ",
+        int(report["throughput"]["answered_per_s"]), " answered/s.", sep="")
+  if ack["count"]:
+    print("Ack latency: p50 %.3f ms, p99 %.3f ms, p999 %.3f ms." %
+          (ack["p50_ms"], ack["p99_ms"], ack["p999_ms"]))
+  print("Results written to ", args.output, ".", sep="")
@@ -5,8 +5,11 @@
 
 from __future__ import print_function
 import sys
+import json
+import time
 import socket
-import struct
+from codec import create_msg, preceding_msg_id
+from framing import FrameReader
 
 __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
@@ -14,89 +17,97 @@ __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
 serv_id = (2 ** 16) - 1  # Server id
 
-#===================================METHODS===================================#
-
-# Create and pack a message with the parameters
-def create_msg(msg_type, orig_id, dest_id, msg_id, payload=None):
-  type_to_int = {
-    'OK': 1, 
-    'ERRO': 2, 
-    'OI': 3, 
-    'FLW': 4, 
-    'MSG': 5, 
-    'CREQ': 6,
-  }
-
-  next_msg_id = msg_id
-
-  if msg_type != 'OK' and msg_type != 'ERRO':
-    next_msg_id += 1
-
-  converted_type = struct.pack("!H", type_to_int[msg_type])
-  orig_id = struct.pack("!H", orig_id)
-  dest_id = struct.pack("!H", dest_id)
-  msg_id = struct.pack("!H", msg_id)
-
-  msg = converted_type + orig_id + dest_id + msg_id
-
-  if msg_type == 'MSG':
-    c = struct.pack("!H", len(payload))
-    msg += c + payload
-  elif msg_type == 'CLIST':
-    msg += payload
-
-  return msg, next_msg_id
+readers = {}  # Maps sockets to their frame readers
+capabilities = {}  # Maps sockets to the capabilities accepted at OI
+
+#===================================CLASSES===================================#
+
+# Cumulative acknowledgements of an exhibitor that negotiated them at OI.
+# Instead of an OK per message, a single OK with the id of the last message
+# received from each origin is sent every `every` messages or `interval`
+# seconds, whichever comes first.
+class Acknowledger(object):
+  def __init__(self, s, this_id, every, interval=None):
+    self.s = s
+    self.this_id = this_id
+    self.every = every
+    self.interval = interval
+    self.last = {}  # orig_id -> id of the last message not acknowledged yet
+    self.count = 0  # Messages not acknowledged yet
+    self.since = None  # When the oldest of them was received
+
+  # Take note of a message, acknowledging everything if it is time to
+  def received(self, orig_id, msg_id):
+    self.last[orig_id] = msg_id
+    self.count += 1
+    if self.since is None:
+      self.since = time.time()
+
+    if self.count >= self.every:
+      self.flush()
+
+  # Seconds until the pending acknowledgements are due, None if there are none
+  def timeout(self):
+    if self.since is None or self.interval is None:
+      return None
+    return max(0, self.since + self.interval - time.time())
+
+  # Acknowledge everything received so far
+  def flush(self):
+    msgs = [create_msg('OK', self.this_id, orig_id, msg_id)[0]
+            for orig_id, msg_id in self.last.items()]
+    if msgs:
+      self.s.sendall(b"".join(bytes(msg) for msg in msgs))
+
+    self.last.clear()
+    self.count = 0
+    self.since = None
 
+#===================================METHODS===================================#
 
 # Send OK message to given socket
 def send_OK(s, orig_id, dest_id, msg_id):
   s.send(create_msg('OK', orig_id, dest_id, msg_id)[0])
 
 
+# Send ERRO message to given socket
+def send_ERRO(s, orig_id, dest_id, msg_id):
+  s.send(create_msg('ERRO', orig_id, dest_id, msg_id)[0])
+
+
 # Send FLW message to given socket
 def send_FLW(s, orig_id, dest_id, msg_id):
   s.send(create_msg('FLW', orig_id, dest_id, msg_id)[0])
 
 
-# Receives and split message, saving it to a dictionary 
+# Receives next message, split into a dictionary. Frames are read in bulk
+# through the socket's frame reader, which keeps whatever arrived after it.
 def receive_msg(s):
-  msg = {}
-  msg_type = s.recv(2)
-
-  if msg_type:
-    msg['type'] = struct.unpack("!H", msg_type)[0]
-    msg['orig_id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['dest_id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['msg'] = None
-
-    if msg['type'] == 5:
-      # Message has type MSG and has content. Get size of content.
-      content_size = struct.unpack("!H", s.recv(2))[0] 
-      msg['msg'] = s.recv(content_size)
-    elif msg['type'] == 7:
-      # Message has type CLIST
-      clist_size = struct.unpack("!H", s.recv(2))[0]
-      clist = ""
-      for i in range(clist_size):
-        clist += str(struct.unpack("!H", s.recv(2))[0])
-        if i != clist_size - 1:
-          # If not last element
-          clist += ", "
-      msg['msg'] = [clist_size, clist]
-
-    return msg
+  if s not in readers:
+    readers[s] = FrameReader(s)
+  return readers[s].receive()
 
-  else:
-    # Empty message has been received. Client has disconnected.
-    return None
+
+# Receives every message that has arrived, waiting for one if there is none.
+# Returns an empty list if the peer closed the connection.
+def receive_msgs(s):
+  if s not in readers:
+    readers[s] = FrameReader(s)
+  reader = readers[s]
+
+  while True:
+    msgs = list(reader.frames())
+    if msgs or not reader.fill():
+      return msgs
 
 
 # Process responses received by the emitter only
 def process_msg(msg, s, this_id, seq_id):
-  if msg['type'] == 1 and msg['id'] == (seq_id - 1):  # OK msg
+  last_id = preceding_msg_id(seq_id)
+
+  if msg['type'] == 1 and msg['id'] == last_id:  # OK msg
     return 
-  elif msg['type'] == 2 and msg['id'] == (seq_id - 1):  # ERRO msg
+  elif msg['type'] == 2 and msg['id'] == last_id:  # ERRO msg
     print("Couldn't deliver message to that id.")
 
   elif msg['type'] == 4:  # FLW msg
@@ -116,10 +127,12 @@ def process_msg(msg, s, this_id, seq_id):
     print("Messages have not been delivered.")
 
 
-# Setup id for clients by sending the OI message to the server
-def execute_OI(s, oi_id):
+# Setup id for clients by sending the OI message to the server. The id of the
+# OI asks for the capabilities in caps, the ones accepted are kept in
+# capabilities.
+def execute_OI(s, oi_id, caps=0):
   # Sends the OI message after connection to server
-  msg, seq_id = create_msg('OI', oi_id, serv_id, 0)
+  msg, seq_id = create_msg('OI', oi_id, serv_id, caps)
   s.send(msg)
 
   # Receives server response with the client id
@@ -127,6 +140,7 @@ def execute_OI(s, oi_id):
   if msg['type'] == 1:
     # Server returned OK message
     this_id = msg['dest_id']
+    capabilities[s] = msg['id'] & caps
     print("The id assigned to this client is", str(this_id) + ".")
 
     if oi_id != 0 and oi_id != 1:
@@ -161,4 +175,63 @@ def represents_int(s):
     int(s)
     return True
   except ValueError:
-    return False
\ No newline at end of file
+    return False
+
+
+# Check if a given string represents an id that fits in a message header
+def represents_id(s):
+  return represents_int(s) and 0 <= int(s) <= serv_id
+
+# Parse a line typed in the emitter format into (type, dest_id, payload).
+# Returns None if it isn't a valid MSG or CREQ.
+def parse_command(line):
+  parameter = line[line.find("(")+1:line.find(")")]
+  rest = line[line.find(")")+1:]
+
+  if parameter == 'CREQ':
+    if represents_id(rest):
+      return 'CREQ', int(rest), None
+  elif represents_id(parameter):
+    return 'MSG', int(parameter), rest
+  return None
+
+
+# Generate the records of an input stream as (type, dest_id, payload), one
+# line at a time so the input never has to fit in memory. Lines are either
+# in the emitter format or, with jsonl set, JSON objects with optional
+# "type", "dest_id" and "msg" fields. Objects without "msg" are sent whole
+# and those without "dest_id" go to default_dest. Invalid lines give None.
+def read_records(f, jsonl=False, default_dest=0):
+  for line in f:
+    line = line.rstrip("\r\n")
+    if not line.strip():
+      continue
+
+    if not jsonl:
+      yield parse_command(line)
+      continue
+
+    try:
+      yield parse_record(json.loads(line), line, default_dest)
+    except (ValueError, TypeError):
+      yield None
+
+
+# Turn a decoded JSON line into (type, dest_id, payload). Returns None if
+# dest_id doesn't fit in a message header.
+def parse_record(record, line, default_dest):
+  if not isinstance(record, dict):
+    return 'MSG', default_dest, line
+
+  dest_id = int(record.get('dest_id', default_dest))
+  if not 0 <= dest_id <= serv_id:
+    return None
+  if record.get('type', 'MSG') == 'CREQ':
+    return 'CREQ', dest_id, None
+  elif 'msg' not in record:
+    return 'MSG', dest_id, line
+
+  payload = record['msg']
+  if not hasattr(payload, "encode"):
+    payload = json.dumps(payload)
+  return 'MSG', dest_id, payload
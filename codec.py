@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Wire Codec"""
+
+from __future__ import print_function
+import sys
+import zlib
+import struct
+from array import array
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+# Message types
+OK = 1
+ERRO = 2
+OI = 3
+FLW = 4
+MSG = 5
+CREQ = 6
+CLIST = 7
+BMSG = 8  # Batch of (dest_id, content) records in a single frame
+BACK = 9  # Answer to a BMSG with the status(OK or ERRO) of every record
+STATS = 10  # Request for the server metrics, answered with them as JSON
+FRAG = 11  # Part of a MSG too large for a frame, continued by the next FRAG
+           # or the final MSG with the same id
+ZMSG = 12  # MSG with its content compressed with zlib
+JOIN = 13  # Exhibitor joins the group in dest_id
+LEAVE = 14  # Exhibitor leaves the group in dest_id
+
+type_to_int = {
+  'OK': OK,
+  'ERRO': ERRO,
+  'OI': OI,
+  'FLW': FLW,
+  'MSG': MSG,
+  'CREQ': CREQ,
+  'CLIST': CLIST,
+  'BMSG': BMSG,
+  'BACK': BACK,
+  'STATS': STATS,
+  'FRAG': FRAG,
+  'ZMSG': ZMSG,
+  'JOIN': JOIN,
+  'LEAVE': LEAVE,
+}
+
+# Capabilities a client asks for in the id of its OI message. The server
+# answers with the ones it accepted in the id of the OK, so clients that
+# always send 0 keep the original protocol.
+CAP_BATCH = 1  # Sends BMSG and receives it instead of several MSG
+CAP_CUMULATIVE = 2  # Each OK acknowledges everything up to its id
+CAP_STREAM = 4  # Receives payloads larger than a frame as FRAG streams
+CAP_ZLIB = 8  # Receives ZMSG instead of having it decompressed into a MSG
+
+header = struct.Struct("!HHHH")  # type, orig_id, dest_id, msg_id
+length = struct.Struct("!H")  # MSG content size and CLIST client count
+msg_header = struct.Struct("!HHHHH")  # MSG header followed by content size
+record = struct.Struct("!HH")  # BMSG record destination and content size
+
+max_msg_id = 2 ** 16 - 1  # Message ids wrap around after this one
+
+# Ids reserved for multicast groups. A MSG or CREQ to one of them reaches the
+# exhibitors that joined it.
+first_group = 2 ** 13
+last_group = 2 ** 14 - 1
+max_content = 2 ** 16 - 1  # Largest content of a single frame
+compress_threshold = 256  # Smallest payload worth compressing, in bytes
+
+# Client ids are sent in network order, array('H') uses the machine's
+swap_ids = sys.byteorder == "little"
+
+#===================================METHODS===================================#
+
+# Create and pack a message with the parameters
+def create_msg(msg_type, orig_id, dest_id, msg_id, payload=None):
+  code = type_to_int[msg_type]
+  next_msg_id = msg_id
+
+  if code != OK and code != ERRO and code != BACK:
+    next_msg_id = following_msg_id(msg_id)
+
+  if code == BMSG:
+    # Payload is a list of (dest_id, content) records
+    payload = encode_batch(payload)
+
+  if code == STATS and payload is None:
+    # Requests have no content
+    payload = b""
+
+  if code in (MSG, BMSG, STATS, FRAG, ZMSG):
+    payload = to_bytes(payload)
+    msg = bytearray(msg_header.size + len(payload))
+    pack_msg_into(msg, 0, orig_id, dest_id, msg_id, payload, code)
+  elif code == BACK:
+    # Payload is the status of every record
+    msg = bytearray(header.size + length.size + len(payload))
+    header.pack_into(msg, 0, code, orig_id, dest_id, msg_id)
+    length.pack_into(msg, header.size, len(payload))
+    msg[header.size + length.size:] = bytearray(payload)
+  elif code == CLIST:
+    msg = bytearray(header.size + len(payload))
+    header.pack_into(msg, 0, code, orig_id, dest_id, msg_id)
+    msg[header.size:] = payload
+  else:
+    msg = header.pack(code, orig_id, dest_id, msg_id)
+
+  return msg, next_msg_id
+
+
+# Returns True if dest_id is the id of a multicast group
+def is_group(dest_id):
+  return first_group <= dest_id <= last_group
+
+
+# Message id that comes after msg_id. Wraps around to 1, since 0 is the id of
+# the OI message.
+def following_msg_id(msg_id):
+  return msg_id % max_msg_id + 1
+
+
+# Message id that came before msg_id, undoing following_msg_id
+def preceding_msg_id(msg_id):
+  return (msg_id - 2) % max_msg_id + 1
+
+
+# Same frame as create_msg, split into a list of buffers so the payload is
+# never copied. Meant for gather writes.
+def create_msg_parts(msg_type, orig_id, dest_id, msg_id, payload=None):
+  code = type_to_int[msg_type]
+
+  if code == MSG:
+    payload = to_bytes(payload)
+    return [msg_header.pack(code, orig_id, dest_id, msg_id, len(payload)),
+            payload]
+  elif code == CLIST:
+    return [header.pack(code, orig_id, dest_id, msg_id), payload]
+  return [header.pack(code, orig_id, dest_id, msg_id)]
+
+
+# Pack a MSG(or BMSG, STATS, FRAG or ZMSG) frame into buf at offset, which
+# must have room for it. Returns the offset right after the frame, so several
+# frames can share a buffer.
+def pack_msg_into(buf, offset, orig_id, dest_id, msg_id, payload, code=MSG):
+  msg_header.pack_into(buf, offset, code, orig_id, dest_id, msg_id,
+                       len(payload))
+  offset += msg_header.size
+  buf[offset:offset + len(payload)] = payload
+  return offset + len(payload)
+
+
+# Content of a BMSG carrying the given (dest_id, content) records
+def encode_batch(records):
+  body = bytearray()
+  for dest_id, payload in records:
+    payload = to_bytes(payload)
+    body += record.pack(dest_id, len(payload))
+    body += payload
+  return body
+
+
+# Generate the (dest_id, content) records of the content of a BMSG. Contents
+# are views into it.
+def decode_batch(body):
+  body = memoryview(body)
+  offset = 0
+
+  while offset + record.size <= len(body):
+    dest_id, size = record.unpack_from(body, offset)
+    offset += record.size
+    yield dest_id, body[offset:offset + size]
+    offset += size
+
+
+# Frames streaming a payload given in chunks of up to max_content bytes: a
+# FRAG for every chunk but the last, which goes in the final MSG. Chunks are
+# consumed one ahead of the frames, as they are sent, so the payload never
+# has to be in memory at once.
+def stream_frames(orig_id, dest_id, msg_id, chunks):
+  previous = None
+  for chunk in chunks:
+    if previous is not None:
+      yield create_msg('FRAG', orig_id, dest_id, msg_id, previous)[0]
+    previous = chunk
+
+  yield create_msg('MSG', orig_id, dest_id, msg_id, previous or b"")[0]
+
+
+# Split a payload into chunks that fit in a frame, as views into it
+def split_payload(payload, size=max_content):
+  payload = memoryview(to_bytes(payload))
+  for offset in range(0, len(payload), size):
+    yield payload[offset:offset + size]
+
+
+# Read a binary file in chunks that fit in a frame
+def read_chunks(f, size=max_content):
+  return iter(lambda: f.read(size), b"")
+
+
+# Type and content to send payload with: ZMSG with the payload compressed if
+# it has at least threshold bytes and compressing makes it smaller, MSG with
+# the payload as is otherwise
+def compress_payload(payload, threshold=compress_threshold):
+  payload = to_bytes(payload)
+  if len(payload) >= threshold:
+    compressed = zlib.compress(payload)
+    if len(compressed) < len(payload):
+      return 'ZMSG', compressed
+  return 'MSG', payload
+
+
+# Payload of the content of a ZMSG. None if it isn't valid zlib data or
+# wouldn't fit in a MSG.
+def decompress_payload(content, limit=max_content):
+  decompressor = zlib.decompressobj()
+  try:
+    payload = decompressor.decompress(memoryview(content).tobytes(),
+                                      limit + 1)
+  except zlib.error:
+    return None
+
+  if len(payload) > limit or not getattr(decompressor, "eof", True):
+    return None
+  return payload
+
+
+# Split the header of the frame at offset into (type, orig_id, dest_id, id)
+def decode_header(buf, offset=0):
+  return header.unpack_from(buf, offset)
+
+
+# Size of the content of the MSG frame at offset
+def decode_msg_size(buf, offset=0):
+  return length.unpack_from(buf, offset + header.size)[0]
+
+
+# Client ids carried by the CLIST frame at offset, as an array('H')
+def decode_clist(buf, offset=0):
+  n = length.unpack_from(buf, offset + header.size)[0]
+  start = offset + header.size + length.size
+  ids = array('H')
+  array_extend(ids, memoryview(buf)[start:start + length.size * n])
+  if swap_ids:
+    ids.byteswap()
+  return ids
+
+
+# Returns payload as bytes, encoding text as UTF-8
+def to_bytes(payload):
+  if isinstance(payload, (bytes, bytearray, memoryview)):
+    return payload
+  return payload.encode("utf-8")
+
+
+# Append raw bytes to an array (fromstring on Python 2)
+def array_extend(ids, data):
+  if hasattr(ids, "frombytes"):
+    ids.frombytes(data)
+  else:
+    ids.fromstring(data.tobytes())
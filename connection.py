@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Connection State"""
+
+from __future__ import print_function
+import errno
+import socket
+from framing import FrameReader
+from metrics import stats
+
+try:
+  import selectors
+except ImportError:
+  try:
+    # Python 2 has the selectors2 backport when installed
+    import selectors2 as selectors
+  except ImportError:
+    # Otherwise select() does, for up to FD_SETSIZE clients
+    import select_selector as selectors
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+# Errors that only mean the socket isn't ready yet
+retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+high_water = 2 ** 18  # Outbound bytes from which a connection is congested
+low_water = 2 ** 16  # Outbound bytes under which it stops being congested
+max_iov = 1024  # Buffers a single sendmsg call takes(IOV_MAX on Linux)
+
+gathered = set()  # Connections with frames sent this tick, not written yet
+broken = set()  # Connections whose peer was found gone when writing to it
+
+#===================================CLASSES===================================#
+
+# State of a client connection, registered with the selector as its data.
+# Reads go through the frame reader and writes that the socket can't take
+# right away are kept until it becomes writable.
+#
+# Once the outbound data reaches the high water mark the connection is
+# congested until it is flushed under the low water mark. The server refuses
+# to forward to congested connections, and those with throttle set aren't
+# read from either, since they are not consuming the answers to what they
+# send. A connection can also be paused until another one is no longer
+# congested, for what it sends to go no faster than the other takes it.
+#
+# With coalesce set, frames sent to a connection aren't written right away
+# but gathered until write_gathered is called at the end of the tick, and
+# written together with a single sendmsg. Nagle's algorithm is disabled
+# then, since it would only delay what is already coalesced. Gathered bytes
+# count as outbound ones, so a connection is congested as soon as a tick has
+# sent it more than it can take.
+class Connection(object):
+  def __init__(self, s, sel, high_water=high_water, low_water=low_water,
+               coalesce=False):
+    s.setblocking(False)
+    if coalesce:
+      s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.s = s
+    self.sel = sel
+    self.reader = FrameReader(s, views=True)
+    self.outbound = bytearray()  # Data waiting for write readiness
+    self.high_water = high_water
+    self.low_water = low_water
+    self.congested = False
+    self.throttle = False  # Stop reading while congested
+    self.paused = False  # Not read from until a congested connection drains
+    self.blocked = []  # Connections paused until this one drains
+    self.caps = 0  # Capabilities negotiated at OI
+    self.closed = False
+    self.coalesce = coalesce
+    self.iov = []  # Frames sent this tick, while coalescing
+    self.gathered_bytes = 0  # And their size
+
+    self.events = selectors.EVENT_READ
+    sel.register(s, self.events, self)
+
+  def fileno(self):
+    return self.s.fileno()
+
+  # Drain the socket into the frame reader. Returns False if peer is gone.
+  def read(self):
+    try:
+      n = self.reader.fill()
+      stats.bytes_in += n
+      return n > 0
+    except socket.error as e:
+      if e.errno in retry_errors:
+        return True
+      # Connection reset and the like
+      return False
+
+  # Generate every complete frame received so far
+  def frames(self):
+    return self.reader.frames()
+
+  # Send a frame or batch of frames. Written at the end of the tick while
+  # coalescing, so data may be a view into a receive buffer that isn't filled
+  # again until then.
+  def send(self, data):
+    if self.coalesce and not self.closed:
+      self.gather([data])
+    else:
+      self.write(data)
+
+  # Send several buffers as a single frame or batch of frames
+  def sendv(self, buffers):
+    if self.coalesce and not self.closed:
+      self.gather(buffers)
+    else:
+      self.writev(buffers)
+
+  # Keep buffers to be written at the end of the tick
+  def gather(self, buffers):
+    if not self.iov:
+      gathered.add(self)
+    self.iov.extend(buffers)
+    self.gathered_bytes += sum(len(data) for data in buffers)
+
+    if (not self.congested and
+        len(self.outbound) + self.gathered_bytes >= self.high_water):
+      self.congested = True
+      self.update_events()
+
+  # Write every frame sent this tick, in as few calls as possible
+  def write_gathered(self):
+    buffers = self.iov
+    self.iov = []
+    self.gathered_bytes = 0
+    if len(buffers) == 1:
+      self.write(buffers[0])
+    else:
+      self.writev(buffers)
+
+    if (self.congested and not self.closed and
+        len(self.outbound) <= self.low_water):
+      # The socket took what congested it
+      self.congested = False
+      self.release()
+      self.update_events()
+
+  # Write data now if possible and keep a copy of whatever didn't fit for
+  # later, so data may be a view into a receive buffer
+  def write(self, data):
+    if self.closed:
+      return
+
+    if not self.outbound:
+      try:
+        sent = self.s.send(data)
+      except socket.error as e:
+        if e.errno not in retry_errors:
+          # Peer is gone
+          self.fail()
+          return
+        sent = 0
+
+      stats.bytes_out += sent
+      if sent == len(data):
+        return
+      data = memoryview(data)[sent:]
+
+    self.queue(data)
+
+  # Write several buffers, gathering them in sendmsg calls of up to max_iov
+  # buffers instead of joining them first when possible
+  def writev(self, buffers):
+    for start in range(0, len(buffers), max_iov):
+      if self.closed:
+        return
+      chunk = buffers[start:start + max_iov]
+
+      if self.outbound or not hasattr(self.s, "sendmsg"):
+        # Ordering is kept by the outbound buffer, or no gather send available
+        for data in chunk:
+          self.write(data)
+        continue
+
+      try:
+        sent = self.s.sendmsg(chunk)
+      except socket.error as e:
+        if e.errno not in retry_errors:
+          self.fail()
+          return
+        sent = 0
+      stats.bytes_out += sent
+
+      for data in chunk:
+        if sent >= len(data):
+          sent -= len(data)
+          continue
+        self.queue(memoryview(data)[sent:])
+        sent = 0
+
+  # Keep data to be written once the socket is writable again
+  def queue(self, data):
+    self.outbound += data
+
+    if len(self.outbound) >= self.high_water:
+      self.congested = True
+    self.update_events()
+
+  # Write as much of the outbound data as the socket takes. Called on write
+  # readiness.
+  def flush(self):
+    try:
+      sent = self.s.send(self.outbound)
+    except socket.error as e:
+      if e.errno not in retry_errors:
+        self.fail()
+        return
+      sent = 0
+
+    stats.bytes_out += sent
+    del self.outbound[:sent]
+
+    if self.congested and len(self.outbound) <= self.low_water:
+      self.congested = False
+      self.release()
+    self.update_events()
+
+  # Report the peer as gone, for the server to kill the client. Its read
+  # event can't be relied on to do it, since a throttled connection isn't
+  # waiting for one.
+  def fail(self):
+    if not self.closed:
+      broken.add(self)
+
+  # Stop reading from this connection until other is no longer congested
+  def wait_for(self, other):
+    self.paused = True
+    other.blocked.append(self)
+    self.update_events()
+
+  # Read from this connection again
+  def resume(self):
+    self.paused = False
+    if not self.closed:
+      self.update_events()
+
+  # Resume every connection paused until this one drains
+  def release(self):
+    blocked = self.blocked
+    self.blocked = []
+    for conn in blocked:
+      conn.resume()
+
+  # Wait for write readiness only while there is outbound data, and for read
+  # readiness unless the connection is throttled or paused. Not every
+  # selector takes an empty set of events, so a connection waiting for none
+  # is unregistered until it waits for some again.
+  def update_events(self):
+    events = 0
+    if self.outbound:
+      events |= selectors.EVENT_WRITE
+    if not (self.congested and self.throttle) and not self.paused:
+      events |= selectors.EVENT_READ
+
+    if events == self.events:
+      return
+    if not events:
+      self.sel.unregister(self.s)
+    elif not self.events:
+      self.sel.register(self.s, events, self)
+    else:
+      self.sel.modify(self.s, events, self)
+    self.events = events
+
+  # Unregister from the selector and close the socket, after writing what it
+  # was sent this tick(the answer to a FLW, for one)
+  def close(self):
+    if self.closed:
+      return
+    if self.iov:
+      self.write_gathered()
+    self.closed = True
+    if self.events:
+      self.sel.unregister(self.s)
+    self.s.close()
+    self.release()
+
+#===================================METHODS===================================#
+
+# Write what every connection was sent this tick. Called once per pass of the
+# event loop, after every event has been handled.
+def write_gathered():
+  while gathered:
+    gathered.pop().write_gathered()
@@ -5,17 +5,157 @@
 
 from __future__ import print_function
 import sys
+import time
 import socket
 import struct
+import argparse
 import client_utils as utils
+from codec import CAP_BATCH, CAP_STREAM, CAP_ZLIB, record, to_bytes
+from codec import split_payload, read_chunks, compress_payload
+from codec import compress_threshold
+from pipeline import Pipeline
 
 __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
+#==================================CONSTANTS==================================#
+
+max_payload = 2 ** 16 - 1  # Largest MSG content(and BMSG records together)
+
+#===================================METHODS===================================#
+
+# Send every record of the input through a pipeline and print a summary. With
+# batches, consecutive MSG records are grouped into BMSG messages of up to
+# args.batch records. Records too large for a frame are streamed in
+# fragments if the server supports it, and skipped otherwise. With
+# compression, other MSG records of at least args.compress_min bytes are
+# sent compressed.
+def stream(emitter, this_id, seq_id, args):
+  pipeline = Pipeline(emitter, this_id, seq_id, args.window)
+  invalid = 0
+  sent = 0
+  batch = []
+  batch_size = 0
+
+  if args.input == "-":
+    f = sys.stdin
+  else:
+    f = open(args.input)
+  jsonl = args.jsonl or args.input.endswith(".jsonl")
+
+  start = time.time()
+  for entry in utils.read_records(f, jsonl, args.dest):
+    if pipeline.closed:
+      # Server has shut down
+      break
+    if entry is None:
+      invalid += 1
+      continue
+
+    msg_type, dest_id, payload = entry
+    if payload is not None and len(to_bytes(payload)) > max_payload:
+      if not utils.capabilities[emitter] & CAP_STREAM:
+        invalid += 1
+        continue
+      pipeline.send_stream(dest_id, split_payload(payload))
+      sent += 1
+      continue
+
+    if msg_type == 'MSG' and args.batch > 1:
+      payload = to_bytes(payload)
+      if batch and batch_size + record.size + len(payload) > max_payload:
+        pipeline.send_batch(batch, retries=args.retries)
+        batch = []
+        batch_size = 0
+
+      if record.size + len(payload) <= max_payload:
+        batch.append((dest_id, payload))
+        batch_size += record.size + len(payload)
+        sent += 1
+        if len(batch) == args.batch:
+          pipeline.send_batch(batch, retries=args.retries)
+          batch = []
+          batch_size = 0
+        continue
+
+    if msg_type == 'MSG' and utils.capabilities[emitter] & CAP_ZLIB:
+      msg_type, payload = compress_payload(payload, args.compress_min)
+
+    if pipeline.send(msg_type, dest_id, payload, retries=args.retries) is None:
+      # Server has shut down
+      break
+    sent += 1
+
+  if batch:
+    pipeline.send_batch(batch, retries=args.retries)
+  pipeline.shutdown()
+  elapsed = time.time() - start
+  if f is not sys.stdin:
+    f.close()
+
+  print("Sent", sent, "messages in", round(elapsed, 3), "seconds(" +
+        str(int(sent / elapsed) if elapsed else sent), "messages/s).")
+  print(pipeline.ok, "delivered,", pipeline.erro, "failed,", pipeline.retried,
+        "retries and", invalid, "invalid records skipped.")
+
+
+# Send the contents of args.file to args.dest as a single message, streamed a
+# frame at a time so the file never has to fit in memory
+def send_file(emitter, this_id, seq_id, args):
+  if not utils.capabilities[emitter] & CAP_STREAM:
+    emitter.close()
+    sys.exit("Server doesn't accept streamed messages.")
+
+  pipeline = Pipeline(emitter, this_id, seq_id)
+  start = time.time()
+  with open(args.file, "rb") as f:
+    pipeline.send_stream(args.dest, read_chunks(f))
+    pipeline.shutdown()
+    size = f.tell()
+  elapsed = time.time() - start
+
+  print("Sent", size, "bytes in", round(elapsed, 3), "seconds:",
+        "delivered." if pipeline.ok else "couldn't deliver to that id.")
+
+
 #====================================MAIN=====================================# 
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("address", help="server address as HOST:PORT")
+parser.add_argument("exhibitor", nargs="?", type=int, default=1,
+                    help="id of the exhibitor to pair with")
+parser.add_argument("--input", metavar="FILE",
+                    help="send every record of FILE(- for stdin) instead of "
+                         "reading from the prompt")
+parser.add_argument("--jsonl", action="store_true",
+                    help="input has a JSON object per line(default for "
+                         ".jsonl files)")
+parser.add_argument("--file", metavar="FILE",
+                    help="send the contents of FILE to --dest as a single "
+                         "message, of any size")
+parser.add_argument("--dest", type=int, default=0,
+                    help="destination of JSON records without dest_id and "
+                         "of --file(default: broadcast)")
+parser.add_argument("--window", type=int, default=64,
+                    help="messages in flight with --input(default: %(default)s)")
+parser.add_argument("--retries", type=int, default=0,
+                    help="times to resend a message that gets ERRO")
+parser.add_argument("--batch", type=int, default=1,
+                    help="messages to group in a single batch with --input, "
+                         "if the server supports it(default: %(default)s)")
+parser.add_argument("--compress", action="store_true",
+                    help="compress messages sent with --input, if the server "
+                         "supports it")
+parser.add_argument("--compress-min", type=int, default=compress_threshold,
+                    metavar="BYTES",
+                    help="with --compress, smallest message to compress "
+                         "(default: %(default)s)")
+args = parser.parse_args()
+if not utils.represents_id(args.dest):
+  parser.error("--dest must be an id from 0 to %d" % utils.serv_id)
+
 # Set up socket address
-HOST = (sys.argv[1].split(":"))[0]
-PORT = int((sys.argv[1].split(":"))[1])
+HOST = (args.address.split(":"))[0]
+PORT = int((args.address.split(":"))[1])
 ADDR = (HOST, PORT)
 
 # Create socket and connect to server
@@ -24,13 +164,25 @@ emitter.connect(ADDR)
 
 seq_id = 1  # Sequence number for messages. Starts at 1 because OI is executed.
 this_id = 0  # The id for this client in the system
-oi_id = 1  # id used in OI message for setup
+oi_id = args.exhibitor  # id used in OI message for setup
+
+caps = CAP_BATCH if args.input and args.batch > 1 else 0
+if args.input or args.file:
+  caps |= CAP_STREAM
+if args.input and args.compress:
+  caps |= CAP_ZLIB
+this_id = utils.execute_OI(emitter, oi_id, caps)
+if not utils.capabilities[emitter] & CAP_BATCH:
+  args.batch = 1
 
-if len(sys.argv) == 3:
-  # If an exhibitor number has been given
-  oi_id = int(sys.argv[2])
+if args.file:
+  send_file(emitter, this_id, seq_id, args)
+  sys.exit()
 
-this_id = utils.execute_OI(emitter, oi_id)
+if args.input:
+  # Bulk mode, no prompt
+  stream(emitter, this_id, seq_id, args)
+  sys.exit()
 
 # Format to send messages
 print("\nThere are three types of messages. Their formats are as follows:\n\n"
@@ -40,7 +192,8 @@ print("\nThere are three types of messages. Their formats are as follows:\n\n"
       "The first one sends MESSAGE to the specified exhibitor id(or emitter in"
       " the case of associated pairs). The second one sends a CLIST message to"
       " id. The third and last disconnects the client from the server. In the "
-      "first two, use 0 as id to execute a broadcast.\n")
+      "first two, use 0 as id to execute a broadcast, or the id of a group("
+      "8192 to 16383) to reach only the exhibitors that joined it.\n")
 
 while True:
   try:
@@ -53,7 +206,7 @@ while True:
 
     elif parameter == 'CREQ':
       dest_id = msg[msg.find(")")+1:]
-      if utils.represents_int(dest_id):
+      if utils.represents_id(dest_id):
         # Sends message to server
         msg, seq_id = utils.create_msg('CREQ', this_id, int(dest_id), seq_id)
         emitter.send(msg)
@@ -63,7 +216,7 @@ while True:
         utils.process_msg(response, emitter, this_id, seq_id)
       else:
         print("Invalid CREQ message id.")
-    elif utils.represents_int(parameter):
+    elif utils.represents_id(parameter):
       # Message has type MSG. parameter contains dest_id.
       msg = msg[msg.find(")")+1:]  # Gets typed data
 
@@ -5,17 +5,154 @@
 
 from __future__ import print_function
 import sys
+import errno
+import select
+import signal
 import socket
 import struct
+import argparse
+import sinks
 import client_utils as utils
+from codec import CAP_BATCH, CAP_CUMULATIVE, CAP_STREAM, CAP_ZLIB
+from codec import create_msg, decode_batch, decompress_payload
+from codec import first_group, last_group, following_msg_id
 
 __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
+#===================================METHODS===================================#
+
+# Acknowledge a message, cumulatively or with an OK that goes out along with
+# those of the rest of its batch
+def acknowledge(msg):
+  if acks is not None:
+    acks.received(msg['orig_id'], msg['id'])
+  else:
+    oks.append(create_msg('OK', this_id, msg['orig_id'], msg['id'])[0])
+
+
+# Show a batch of messages and only then acknowledge them, with a single
+# write for all of them and a single send for their OKs
+def finish_batch():
+  sink.flush()
+  if oks:
+    exhibitor.sendall(b"".join(bytes(ok) for ok in oks))
+    del oks[:]
+
+
+# Hand a message to the sink. Returns False once the server has shut down.
+def handle(msg):
+  if msg['type'] == 4:  # FLW message
+    finish_batch()
+    if acks is not None:
+      acks.flush()
+
+    # Send OK acknowledgement
+    utils.send_OK(exhibitor, this_id, server_id, msg['id'])
+
+    print("Received a FLW message. Shutting down now.")
+    return False
+
+  if msg['type'] == 2 and msg['id'] in joins:  # ERRO to a JOIN message
+    print("Couldn't join group", str(joins.pop(msg['id'])) + ".")
+    return True
+
+  if msg['type'] == 1 and msg['id'] in joins:  # OK to a JOIN message
+    group_id = joins.pop(msg['id'])
+    groups.add(group_id)
+    print("Joined group", str(group_id) + ".")
+    return True
+
+  if msg['type'] == 2 and msg['id'] in leaves:  # ERRO to a LEAVE message
+    print("Couldn't leave group", str(leaves.pop(msg['id'])) + ".")
+    return True
+
+  if msg['type'] == 1 and msg['id'] in leaves:  # OK to a LEAVE message
+    print("Left group", str(leaves.pop(msg['id'])) + ".")
+    return True
+
+  if msg['type'] == 5:  # MSG message
+    key = (msg['orig_id'], msg['id'])
+    if key in streams:
+      # Final part of a streamed message
+      streams.remove(key)
+      sink.fragment(msg['orig_id'], msg['id'], msg['msg'], True)
+    else:
+      sink.message(msg['orig_id'], msg['msg'])
+
+    acknowledge(msg)
+
+  elif msg['type'] == 12:  # ZMSG message
+    payload = decompress_payload(msg['msg'])
+    if payload is None:
+      print("Couldn't decompress message from", str(msg['orig_id']) + ".")
+      utils.send_ERRO(exhibitor, this_id, msg['orig_id'], msg['id'])
+      return True
+    sink.message(msg['orig_id'], payload)
+
+    acknowledge(msg)
+
+  elif msg['type'] == 11:  # FRAG message
+    # Part of a large message, acknowledged with its final MSG
+    streams.add((msg['orig_id'], msg['id']))
+    sink.fragment(msg['orig_id'], msg['id'], msg['msg'])
+
+  elif msg['type'] == 8:  # BMSG message
+    # Several messages from the same client, acknowledged at once
+    for dest_id, content in decode_batch(msg['msg']):
+      sink.message(msg['orig_id'], content)
+
+    acknowledge(msg)
+
+  elif msg['type'] == 7:  # CLIST message
+    sink.clist(msg['orig_id'], msg['msg'][1])
+
+    acknowledge(msg)
+
+  return True
+
+
+# Ask for the groups to be left at the top of the main loop, which the wakeup
+# socket gets it back to. Sending from here could cut into another send.
+def request_leave(signum, frame):
+  global leave_requested
+  leave_requested = True
+
+
+# Leave every group joined so far. Their answers arrive along with the
+# messages.
+def leave_groups():
+  global next_id
+  for group_id in sorted(groups):
+    exhibitor.send(create_msg('LEAVE', this_id, group_id, next_id)[0])
+    leaves[next_id] = group_id
+    next_id = following_msg_id(next_id)
+  groups.clear()
+
 #====================================MAIN=====================================#
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("address", help="server address as HOST:PORT")
+parser.add_argument("--cumulative", action="store_true",
+                    help="acknowledge many messages at once, if the server "
+                         "supports it")
+parser.add_argument("--ack-every", type=int, default=16, metavar="N",
+                    help="with --cumulative, acknowledge every N messages "
+                         "(default: %(default)s)")
+parser.add_argument("--ack-ms", type=float, default=1, metavar="T",
+                    help="with --cumulative, acknowledge at most T "
+                         "milliseconds after a message(default: %(default)s)")
+parser.add_argument("--output", metavar="FILE",
+                    help="append the messages to FILE instead of showing them")
+parser.add_argument("--join", type=int, action="append", default=[],
+                    metavar="GROUP",
+                    help="receive the messages sent to GROUP(%d to %d), may "
+                         "be given more than once. SIGUSR1 leaves every "
+                         "group joined" % (first_group, last_group))
+args = parser.parse_args()
+
 # Set up socket address
-HOST = (sys.argv[1].split(":"))[0]
-PORT = int((sys.argv[1].split(":"))[1])
+HOST = (args.address.split(":"))[0]
+PORT = int((args.address.split(":"))[1])
 ADDR = (HOST, PORT)
 
 # Create socket and connect to server
@@ -25,33 +162,94 @@ exhibitor.connect(ADDR)
 server_id = (2 ** 16) - 1
 this_id = 0  # The id for this client in the system
 
-this_id = utils.execute_OI(exhibitor, 0)
+caps = CAP_BATCH | CAP_STREAM | CAP_ZLIB
+if args.cumulative:
+  caps |= CAP_CUMULATIVE
+this_id = utils.execute_OI(exhibitor, 0, caps)
+
+if args.output:
+  sink = sinks.FileSink(args.output)
+else:
+  sink = sinks.TextSink()
+streams = set()  # (orig_id, msg_id) of the messages being streamed
+
+# Join the groups asked for. Their answers arrive along with the messages.
+joins = {}  # Message id -> group id of the JOINs not answered yet
+leaves = {}  # Message id -> group id of the LEAVEs not answered yet
+groups = set()  # Groups joined and not left
+next_id = 1  # Id for the next JOIN or LEAVE
+for group_id in args.join:
+  exhibitor.send(create_msg('JOIN', this_id, group_id, next_id)[0])
+  joins[next_id] = group_id
+  next_id = following_msg_id(next_id)
+oks = []  # OKs for the batch being handled
+
+acks = None
+if utils.capabilities[exhibitor] & CAP_CUMULATIVE:
+  acks = utils.Acknowledger(exhibitor, this_id, args.ack_every,
+                            args.ack_ms / 1000.0)
+
+# Signals write to this socket, waking the main loop up to handle them
+wakeup = None
+leave_requested = False
+if hasattr(signal, "SIGUSR1"):
+  wakeup, wakeup_w = socket.socketpair()
+  wakeup.setblocking(False)
+  wakeup_w.setblocking(False)
+  signal.set_wakeup_fd(wakeup_w.fileno())
+  signal.signal(signal.SIGUSR1, request_leave)
+waiting = [s for s in (exhibitor, wakeup) if s is not None]
 
 while True:
   try:
-    msg = utils.receive_msg(exhibitor)
-
-    if msg['type'] == 4:  # FLW message
-      # Send OK acknowledgement
-      utils.send_OK(exhibitor, this_id, server_id, msg['id'])
-
-      print("Received a FLW message. Shutting down now.")
-      
-      # Close connection
-      exhibitor.close()
-
-      # End script
+    timeout = None
+    if acks is not None:
+      # Wake up in time to send the acknowledgements that are due
+      timeout = acks.timeout()
+      if timeout == 0:
+        acks.flush()
+        timeout = None
+
+    try:
+      ready = select.select(waiting, [], [], timeout)[0]
+    except (select.error, OSError) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      # Interrupted by a signal on Python 2, which the wakeup socket has
+      continue
+
+    if leave_requested:
+      leave_requested = False
+      leave_groups()
+    if wakeup in ready:
+      try:
+        wakeup.recv(64)
+      except socket.error:
+        pass
+    if exhibitor not in ready:
+      if not ready:
+        acks.flush()
+      continue
+
+    # Every message that has arrived, handled as a batch
+    msgs = utils.receive_msgs(exhibitor)
+
+    if not msgs:
+      finish_batch()
+      print("Server has closed the connection.")
       break
 
-    if msg['type'] == 5:  # MSG message
-      print("Message from", str(msg['orig_id']) + ":", msg['msg'])
-
-      utils.send_OK(exhibitor, this_id, msg['orig_id'], msg['id'])
-
-    elif msg['type'] == 7:  # CLIST message
-      print("There are", msg['msg'][0], "clients connected to the server. "
-            "These are their ids:", msg['msg'][1])
-
-      utils.send_OK(exhibitor, this_id, msg['orig_id'], msg['id'])
+    if not all(handle(msg) for msg in msgs):
+      break
+    finish_batch()
   except KeyboardInterrupt:
-    utils.execute_FLW(exhibitor, this_id, 0)
\ No newline at end of file
+    # Show and acknowledge what was handled before saying goodbye
+    finish_batch()
+    if acks is not None:
+      acks.flush()
+    sink.close()
+    utils.execute_FLW(exhibitor, this_id, 0)
+
+# Close connection
+exhibitor.close()
+sink.close()
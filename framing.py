@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Incremental Frame Parser"""
+
+from __future__ import print_function
+from codec import MSG, CLIST, BMSG, BACK, STATS, FRAG, ZMSG, header, length
+from codec import decode_header, decode_msg_size, decode_clist
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+buffer_size = 2 ** 16  # Initial size of every connection receive buffer
+
+#===================================CLASSES===================================#
+
+# Receive buffer of a connection. Drains the socket with a single recv_into
+# per call to fill and splits as many complete frames as there are available,
+# keeping partial ones for later.
+#
+# With views set, MSG frames are not copied out of the buffer: their content
+# and the whole frame ('frame') are memoryviews that are only valid until the
+# next call to fill.
+class FrameReader(object):
+  def __init__(self, s, size=buffer_size, views=False):
+    self.s = s
+    self.views = views
+    self.buf = bytearray(size)
+    self.view = memoryview(self.buf)
+    self.start = 0  # Where the first unparsed byte is
+    self.end = 0  # Where the received data ends
+
+  # Read whatever the socket has. Returns the number of bytes, 0 when closed.
+  def fill(self):
+    n = self.s.recv_into(self.space())
+    self.end += n
+    return n
+
+  # Free part of the buffer, where the next received bytes must be written.
+  # Whoever writes there must then advance end by the number of bytes.
+  def space(self):
+    if self.end == len(self.buf):
+      self.make_room()
+    return self.view[self.end:]
+
+  # Move the partial frame to the beginning of the buffer, growing it if the
+  # frame can't fit even then
+  def make_room(self):
+    pending = self.end - self.start
+    needed = self.frame_size()
+
+    if needed is not None and needed > len(self.buf):
+      grown = bytearray(needed)
+      grown[:pending] = self.buf[self.start:self.end]
+      self.buf = grown
+      self.view = memoryview(self.buf)
+    else:
+      self.buf[:pending] = self.buf[self.start:self.end]
+
+    self.start = 0
+    self.end = pending
+
+  # Total size of the frame at the start of the buffer, None if still unknown
+  def frame_size(self):
+    available = self.end - self.start
+
+    if available < header.size + length.size:
+      # Only OK, ERRO, OI, FLW, CREQ, JOIN and LEAVE frames are complete with
+      # the header
+      if available < header.size:
+        return None
+      msg_type = length.unpack_from(self.buf, self.start)[0]
+      if msg_type in (MSG, CLIST, BMSG, BACK, STATS, FRAG, ZMSG):
+        return None
+      return header.size
+
+    msg_type = length.unpack_from(self.buf, self.start)[0]
+    if msg_type in (MSG, BMSG, STATS, FRAG, ZMSG):
+      # MSG, BMSG, STATS, FRAG and ZMSG: header, content size and content
+      content_size = decode_msg_size(self.buf, self.start)
+      return header.size + length.size + content_size
+    elif msg_type == CLIST:
+      # CLIST: header, number of clients and their ids
+      clist_size = length.unpack_from(self.buf, self.start + header.size)[0]
+      return header.size + length.size + length.size * clist_size
+    elif msg_type == BACK:
+      # BACK: header, number of records and a status byte for each
+      count = length.unpack_from(self.buf, self.start + header.size)[0]
+      return header.size + length.size + count
+
+    return header.size
+
+  # Generate every complete frame in the buffer, split into a dictionary
+  def frames(self):
+    while True:
+      size = self.frame_size()
+      if size is None or size > self.end - self.start:
+        break
+
+      msg = self.parse(self.start, size)
+      self.start += size
+      if self.start == self.end:
+        # Buffer is empty, start over from the beginning
+        self.start = self.end = 0
+
+      yield msg
+
+  # Split the frame at offset into a dictionary
+  def parse(self, offset, size):
+    msg = {}
+    (msg['type'],
+     msg['orig_id'],
+     msg['dest_id'],
+     msg['id']) = decode_header(self.buf, offset)
+    msg['msg'] = None
+
+    body = offset + header.size + length.size
+    has_content = msg['type'] in (MSG, BMSG, STATS, FRAG, ZMSG)
+    if has_content and self.views:
+      # Message has content. Leave it in the buffer to be forwarded or split
+      # without copies.
+      msg['frame'] = self.view[offset:offset + size]
+      msg['msg'] = msg['frame'][body - offset:]
+    elif has_content:
+      # Message has type MSG, BMSG, STATS, FRAG or ZMSG and has content
+      msg['msg'] = self.view[body:offset + size].tobytes()
+    elif msg['type'] == BACK:
+      # Status of every record of a batch
+      msg['msg'] = bytearray(self.view[body:offset + size])
+    elif msg['type'] == CLIST:
+      # Message has type CLIST. Ids are left in an array('H'), to be
+      # formatted only if they are shown.
+      clist = decode_clist(self.buf, offset)
+      msg['msg'] = [len(clist), clist]
+
+    return msg
+
+  # Block until a whole frame has been received. Returns None if the peer
+  # closed the connection.
+  def receive(self):
+    while True:
+      for msg in self.frames():
+        return msg
+
+      if not self.fill():
+        return None
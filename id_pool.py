@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Client Id Allocator"""
+
+from __future__ import print_function
+import heapq
+from collections import deque
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#===================================CLASSES===================================#
+
+# Pool of the ids in [first, last]. Allocates and releases without probing
+# ids one by one.
+#
+# When lowest_first is set, the lowest free id is always handed out, as the
+# server always did. Free ids are then kept in a heap, so both operations
+# are O(log n). Otherwise ids are recycled in FIFO order from a free list in
+# O(1), which delays the reuse of a just released id.
+class IdAllocator(object):
+  def __init__(self, first, last, lowest_first=True):
+    self.first = first
+    self.size = last - first + 1
+    self.lowest_first = lowest_first
+    self.in_use = bytearray(self.size)  # 1 for every allocated id
+    self.available = self.size
+    self.low_water = self.size // 20  # Warn when only 5% of ids are left
+
+    if lowest_first:
+      # Already a heap, since it is sorted
+      self.free_heap = list(range(first, last + 1))
+    else:
+      self.free_list = deque(range(first, last + 1))
+
+  def __len__(self):
+    return self.available
+
+  # Take a free id. Returns -1 if all of them are in use.
+  def allocate(self):
+    if not self.available:
+      return -1
+
+    if self.lowest_first:
+      i = heapq.heappop(self.free_heap) - self.first
+    else:
+      i = self.free_list.popleft() - self.first
+
+    self.in_use[i] = 1
+    self.available -= 1
+    return self.first + i
+
+  # Give an id back to the pool
+  def release(self, client_id):
+    i = client_id - self.first
+    if not self.in_use[i]:
+      # Never allocated or already released
+      return
+
+    self.in_use[i] = 0
+    self.available += 1
+
+    if self.lowest_first:
+      heapq.heappush(self.free_heap, client_id)
+    else:
+      self.free_list.append(client_id)
+
+  # Returns True if the last allocation has just reached the low water mark
+  def reached_low_water(self):
+    return self.available == self.low_water
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Logging"""
+
+from __future__ import print_function
+import sys
+import threading
+from collections import deque
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+# Levels. TRACE is for what happens to every message, LOG for clients coming
+# and going.
+TRACE = 5
+LOG = 10
+WARNING = 20
+ERROR = 30
+ANNOUNCEMENT = 40
+OFF = 100
+
+levels = {
+  "trace": TRACE,
+  "log": LOG,
+  "warning": WARNING,
+  "error": ERROR,
+  "off": OFF,
+}
+
+tags = {
+  TRACE: "[LOG] ",
+  LOG: "[LOG] ",
+  WARNING: "[WARNING] ",
+  ERROR: "[ERROR] ",
+  ANNOUNCEMENT: "\n[ANNOUNCEMENT] ",
+}
+
+level = TRACE  # Records under this level are discarded right away
+sample = {}  # Event -> only 1 in every N of its records is kept
+max_records = 1024  # Records buffered before they are written anyway
+
+out = sys.stdout
+records = deque()  # (level, format, args) not written yet
+seen = {}  # Event -> records of it so far, for sampling
+writer = None  # Background writer thread, if any
+wake = threading.Event()  # Set to have the writer write right away
+
+#===================================METHODS===================================#
+
+# Keep a record of event. Formatting is left for when it is written, so args
+# must not change afterwards. Costs a comparison if the level is disabled.
+def log(record_level, event, fmt, *args):
+  if record_level < level:
+    return
+
+  if event in sample:
+    n = seen.get(event, 0)
+    seen[event] = n + 1
+    if n % sample[event]:
+      return
+
+  records.append((record_level, fmt, args))
+  if len(records) >= max_records:
+    flush()
+
+
+# Write every buffered record, or have the background writer do it
+def flush():
+  if writer is not None:
+    wake.set()
+  else:
+    write()
+
+
+# Format and write the buffered records with a single write
+def write():
+  lines = []
+  try:
+    while True:
+      record_level, fmt, args = records.popleft()
+      lines.append(tags[record_level] + fmt.format(*args) + "\n")
+  except IndexError:
+    pass
+
+  if lines:
+    out.write("".join(lines))
+    out.flush()
+
+
+# Write records from a thread until the interpreter exits, at least every
+# interval seconds
+def background(interval):
+  while True:
+    wake.wait(interval)
+    wake.clear()
+    write()
+
+
+# Set the level, sampling and destination of the logs. Records are written
+# from a background thread if interval is given, otherwise whenever flush is
+# called(the servers do it after every batch of events).
+def configure(new_level=TRACE, new_sample=None, path=None, interval=None):
+  global level, sample, out, writer
+
+  level = new_level
+  sample = dict(new_sample or {})
+  if path:
+    out = open(path, "a")
+
+  if interval and writer is None:
+    writer = threading.Thread(target=background, args=(interval,))
+    writer.daemon = True
+    writer.start()
+
+
+# Parse "event=N" into (event, N), for command line options
+def parse_sample(text):
+  event, n = text.split("=")
+  return event, max(1, int(n))
+
+
+# Write whatever is left. Called on shutdown.
+def close():
+  write()
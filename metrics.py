@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Metrics"""
+
+from __future__ import print_function
+import os
+import json
+import socket
+import codec
+from pending import now
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+type_names = dict((code, name) for name, code in codec.type_to_int.items())
+
+#===================================CLASSES===================================#
+
+# Distribution of non-negative integers in power of two buckets. Bucket i
+# counts the values with bit length i, that is from 2**(i-1) to 2**i - 1.
+class Histogram(object):
+  def __init__(self):
+    self.buckets = [0] * 33
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  def add(self, value):
+    value = int(value)
+    self.buckets[min(value.bit_length(), 32)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  # Upper bound of the bucket holding quantile q of the values
+  def quantile(self, q):
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= q * self.count:
+        return min((1 << i) - 1, self.max)
+    return 0
+
+  def summary(self):
+    return {
+      "count": self.count,
+      "mean": float(self.total) / self.count if self.count else 0,
+      "max": self.max,
+      "p50": self.quantile(0.5),
+      "p99": self.quantile(0.99),
+      "p999": self.quantile(0.999),
+      "buckets": dict(((1 << i) - 1, n) for i, n in enumerate(self.buckets)
+                      if n),
+    }
+
+
+# Everything counted by the server. Updated in place by the processing
+# functions and connections, which only add to counters, and turned into a
+# dictionary on demand.
+#
+# Reports can also be written every interval seconds to a file(replaced
+# atomically) and/or sent as a datagram to a Unix socket.
+class Metrics(object):
+  def __init__(self):
+    self.started = now()
+    self.received = {}  # Message type -> frames received
+    self.sent = {}  # Message type -> frames sent
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.fanout = Histogram()  # Exhibitors reached by each broadcast
+    self.routing = Histogram()  # Microseconds processing each frame
+    self.ack_rtt = Histogram()  # Microseconds from forward to last answer
+
+    self.path = None
+    self.socket_path = None
+    self.interval = None
+    self.next_report = None
+
+  # Count frames of a type sent
+  def count_sent(self, msg_type, n=1):
+    self.sent[msg_type] = self.sent.get(msg_type, 0) + n
+
+  # Snapshot of the metrics and of the state of the registry and pending table
+  def snapshot(self, registry, pending):
+    exhibitors = len(registry.exhibitors())
+    pools = {}
+    for client_type, pool in registry.pools.items():
+      pools[client_type] = {"used": pool.size - len(pool), "size": pool.size}
+
+    return {
+      "uptime_s": now() - self.started,
+      "received": dict((type_names.get(t, str(t)), n)
+                       for t, n in self.received.items()),
+      "sent": dict((type_names.get(t, str(t)), n)
+                   for t, n in self.sent.items()),
+      "bytes_in": self.bytes_in,
+      "bytes_out": self.bytes_out,
+      "clients": {
+        "emitters": len(registry) - exhibitors,
+        "exhibitors": exhibitors,
+        "pairs": len(registry.emi_to_exh),
+        "groups": len(registry.groups),
+      },
+      "id_pools": pools,
+      "pending": len(pending),
+      "broadcast_fanout": self.fanout.summary(),
+      "routing_us": self.routing.summary(),
+      "ack_rtt_us": self.ack_rtt.summary(),
+    }
+
+  # Write a report every interval seconds to path and/or a Unix socket
+  def report_to(self, path=None, socket_path=None, interval=10.0):
+    self.path = path
+    self.socket_path = socket_path
+    if path or socket_path:
+      self.interval = interval
+      self.next_report = now() + interval
+
+  # Seconds until the next report is due, None if there are no reports
+  def next_timeout(self):
+    if self.next_report is None:
+      return None
+    return max(0, self.next_report - now())
+
+  # Write the report if it is due
+  def report(self, registry, pending):
+    if self.next_report is None or now() < self.next_report:
+      return
+    self.next_report = now() + self.interval
+
+    data = json.dumps(self.snapshot(registry, pending), sort_keys=True)
+    if self.path:
+      # Readers never see a half written file
+      tmp_path = self.path + ".tmp"
+      with open(tmp_path, "w") as f:
+        f.write(data + "\n")
+      os.rename(tmp_path, self.path)
+
+    if self.socket_path:
+      s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      try:
+        s.sendto(data.encode("utf-8"), self.socket_path)
+      except socket.error:
+        # Nobody is listening, or the report doesn't fit a datagram
+        pass
+      finally:
+        s.close()
+
+#===================================METHODS===================================#
+
+# Earliest of two timeouts, where None means no timeout
+def earliest(timeout, other):
+  if timeout is None:
+    return other
+  if other is None:
+    return timeout
+  return min(timeout, other)
+
+
+# Metrics of this server, shared by every module that updates them
+stats = Metrics()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Metrics Monitor"""
+
+from __future__ import print_function
+import sys
+import json
+import time
+import socket
+import argparse
+import client_utils as utils
+from codec import STATS, create_msg
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#===================================METHODS===================================#
+
+# Ask the server for its metrics. Returns them as a dictionary.
+def request_stats(s, msg_id):
+  s.sendall(create_msg('STATS', 0, utils.serv_id, msg_id)[0])
+
+  while True:
+    msg = utils.receive_msg(s)
+    if msg is None:
+      sys.exit("Server has closed the connection.")
+    if msg['type'] == STATS and msg['id'] == msg_id:
+      return json.loads(msg['msg'].decode("utf-8"))
+
+#====================================MAIN=====================================#
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("address", help="server address as HOST:PORT")
+parser.add_argument("--watch", type=float, metavar="SECONDS",
+                    help="keep asking every SECONDS, one JSON object per line")
+args = parser.parse_args()
+
+HOST = (args.address.split(":"))[0]
+PORT = int((args.address.split(":"))[1])
+
+# No OI needed, any connection may ask for the metrics
+monitor = socket.create_connection((HOST, PORT))
+msg_id = 1
+
+try:
+  if not args.watch:
+    print(json.dumps(request_stats(monitor, msg_id), indent=2, sort_keys=True))
+  else:
+    while True:
+      print(json.dumps(request_stats(monitor, msg_id), sort_keys=True))
+      sys.stdout.flush()
+      msg_id = msg_id % 65535 + 1
+      time.sleep(args.watch)
+except KeyboardInterrupt:
+  pass
+
+monitor.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Command Line Options"""
+
+from __future__ import print_function
+import connection
+import logger
+import store
+import server_utils as utils
+from metrics import stats
+from pending import ack_timeout
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#===================================METHODS===================================#
+
+# Add the options every server takes to parser
+def add_server_options(parser):
+  parser.add_argument("port", type=int, help="port to listen on")
+  parser.add_argument("--ack-timeout", type=float, default=ack_timeout,
+                      help="seconds to wait for an exhibitor to acknowledge a "
+                           "message before answering ERRO "
+                           "(default: %(default)s)")
+  parser.add_argument("--id-order", choices=("lowest", "fifo"),
+                      default="lowest",
+                      help="hand out the lowest free id, or recycle released "
+                           "ids in FIFO order (default: %(default)s)")
+  parser.add_argument("--high-water", type=int,
+                      default=connection.high_water,
+                      help="outbound bytes from which a client is considered "
+                           "a slow consumer (default: %(default)s)")
+  parser.add_argument("--low-water", type=int, default=connection.low_water,
+                      help="outbound bytes under which a slow consumer is "
+                           "served again (default: %(default)s)")
+  parser.add_argument("--slow-consumer",
+                      choices=("drop", "erro", "disconnect", "store"),
+                      default=utils.slow_consumer,
+                      help="what to do with messages for a slow consumer: "
+                           "drop them, answer ERRO to the emitter, disconnect "
+                           "it or keep them until it catches up, which needs "
+                           "--store (default: %(default)s)")
+  parser.add_argument("--store", metavar="DIR",
+                      help="keep messages for exhibitors that can't take them "
+                           "yet in a log under DIR, forwarding them once they "
+                           "can")
+  parser.add_argument("--store-max", type=int, default=store.max_bytes >> 20,
+                      metavar="MB",
+                      help="disk the log may take (default: %(default)s)")
+  parser.add_argument("--log-level", choices=sorted(logger.levels),
+                      default="trace",
+                      help="least severe records to log, trace logs every "
+                           "message (default: %(default)s)")
+  parser.add_argument("--log-sample", type=logger.parse_sample,
+                      action="append", metavar="EVENT=N",
+                      help="log only 1 in every N records of EVENT, e.g. "
+                           "send_ok=100")
+  parser.add_argument("--log-file", help="append logs to this file instead "
+                                         "of standard output")
+  parser.add_argument("--log-interval", type=float,
+                      help="write logs from a background thread at least "
+                           "every this many seconds, instead of after every "
+                           "batch of events")
+  parser.add_argument("--stats-file",
+                      help="write the server metrics to this file as JSON "
+                           "every --stats-interval seconds")
+  parser.add_argument("--stats-socket",
+                      help="send the server metrics as a JSON datagram to "
+                           "this Unix socket every --stats-interval seconds")
+  parser.add_argument("--stats-interval", type=float, default=10.0,
+                      help="seconds between metrics reports "
+                           "(default: %(default)s)")
+
+
+# Set up the slow consumer policy, the store, the metrics reports and the
+# logger from the parsed options
+def configure(parser, args):
+  if args.slow_consumer == "store" and not args.store:
+    parser.error("--slow-consumer store needs --store")
+  utils.slow_consumer = args.slow_consumer
+  if args.store:
+    utils.store = store.SegmentLog(args.store, args.store_max << 20)
+  stats.report_to(args.stats_file, args.stats_socket, args.stats_interval)
+  logger.configure(logger.levels[args.log_level], args.log_sample,
+                   args.log_file, args.log_interval)
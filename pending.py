@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Pending Deliveries Table"""
+
+from __future__ import print_function
+import time
+from collections import deque
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+ack_timeout = 5.0  # Default seconds to wait for an exhibitor acknowledgement
+
+# Clock used for deadlines. Falls back to wall time where there is no monotonic
+now = getattr(time, "monotonic", time.time)
+
+#===================================CLASSES===================================#
+
+# A message forwarded to one or more clients that still waits for their answer
+class Delivery(object):
+  def __init__(self, s, orig_id, msg_id, on_done=None):
+    self.s = s  # Socket of the client waiting for the outcome(None if server)
+    self.orig_id = orig_id  # Id of the client that sent the message
+    self.msg_id = msg_id  # Id of the message being delivered
+    self.on_done = on_done  # Called with the delivery instead of answering
+    self.waiting = set()  # Ids of clients that have not answered yet
+    self.targets = 0  # Number of clients the message was sent to
+    self.broadcast = False  # Whether it was sent to every exhibitor
+    self.failed = 0  # Number of clients that answered ERRO or never did
+    self.failed_ids = set()  # And their ids
+    self.refused_ids = set()  # Ids of those that answered ERRO
+    self.deadline = None
+
+  # Count a target as failed
+  def fail(self, target_id):
+    self.failed += 1
+    self.failed_ids.add(target_id)
+
+  # Returns True if every target has answered OK
+  def succeeded(self):
+    return not self.waiting and self.failed == 0
+
+  # Number of targets that answered OK so far
+  def acked(self):
+    return self.targets - self.failed - len(self.waiting)
+
+
+# Maps (target id, origin id, message id) to the delivery waiting for it.
+#
+# Targets in cumulative answer with a single OK for everything they were sent
+# by an origin up to a message id. Frames from an origin reach a target in
+# the order they were sent, so the ids sent to each of those targets are kept
+# in that order to resolve the whole range at once.
+class PendingTable(object):
+  def __init__(self, timeout=ack_timeout):
+    self.timeout = timeout
+    self.entries = {}  # (target_id, orig_id, msg_id) -> Delivery
+    self.by_target = {}  # target_id -> set of keys waiting on that client
+    # Keys that need more than one answer -> answers still owed after the
+    # next one. Only batches split into several frames for a target use it.
+    self.owed = {}
+    self.cumulative = set()  # Targets that acknowledge ranges
+    self.ranges = {}  # target_id -> {orig_id -> deque of ids in send order}
+    # Every delivery gets the same timeout, so appending keeps them sorted
+    self.deadlines = deque()
+
+  def __len__(self):
+    return len(self.entries)
+
+  # Start waiting for the answer of every target. Returns True if it had none.
+  # Targets the message couldn't be sent to must already be counted as failed.
+  # answers maps targets that were sent several frames under the same message
+  # id to how many answers they owe.
+  def add(self, delivery, targets, answers=None):
+    delivery.deadline = now() + self.timeout
+
+    for target_id in targets:
+      key = (target_id, delivery.orig_id, delivery.msg_id)
+      self.entries[key] = delivery
+      self.by_target.setdefault(target_id, set()).add(key)
+      delivery.waiting.add(target_id)
+      if answers and answers.get(target_id, 1) > 1:
+        self.owed[key] = answers[target_id] - 1
+      if target_id in self.cumulative:
+        origins = self.ranges.setdefault(target_id, {})
+        origins.setdefault(delivery.orig_id, deque()).append(delivery.msg_id)
+    delivery.targets = len(delivery.waiting) + delivery.failed
+
+    if delivery.waiting:
+      self.deadlines.append(delivery)
+      return False
+    return True
+
+  # Register an answer. Returns the delivery if it has just been completed.
+  def resolve(self, target_id, orig_id, msg_id, ok):
+    key = (target_id, orig_id, msg_id)
+    if ok and key in self.owed:
+      # Not the last answer this target owes for it
+      self.owed[key] -= 1
+      if not self.owed[key]:
+        del self.owed[key]
+      return None
+
+    delivery = self.entries.pop(key, None)
+    if delivery is None:
+      # Unsolicited answer or it arrived after the deadline
+      return None
+
+    self.owed.pop(key, None)
+    self.by_target[target_id].discard(key)
+    delivery.waiting.discard(target_id)
+    if not ok:
+      delivery.fail(target_id)
+      delivery.refused_ids.add(target_id)
+
+    if delivery.waiting:
+      return None
+    return delivery
+
+  # Register an OK for every message sent to target_id by orig_id up to
+  # msg_id. Returns the deliveries that have just been completed.
+  def resolve_upto(self, target_id, orig_id, msg_id):
+    if (target_id, orig_id, msg_id) not in self.entries:
+      # Stale or unsolicited
+      return []
+
+    ids = self.ranges.get(target_id, {}).get(orig_id)
+    if ids is None:
+      # Sent before the target was known to acknowledge ranges
+      delivery = self.resolve(target_id, orig_id, msg_id, True)
+      return [delivery] if delivery else []
+
+    done = []
+    while ids:
+      earlier_id = ids.popleft()
+      # A single answer covers every frame sent under the same id
+      self.owed.pop((target_id, orig_id, earlier_id), None)
+      delivery = self.resolve(target_id, orig_id, earlier_id, True)
+      if delivery:
+        done.append(delivery)
+      if earlier_id == msg_id:
+        break
+
+    return done
+
+  # Forget the ids at the front of a range that no longer wait for an answer
+  def trim(self, target_id, orig_id):
+    ids = self.ranges.get(target_id, {}).get(orig_id)
+    while ids and (target_id, orig_id, ids[0]) not in self.entries:
+      ids.popleft()
+
+  # Fail everything a disconnected client owed. Returns completed deliveries.
+  def drop_client(self, target_id):
+    done = []
+    self.cumulative.discard(target_id)
+    self.ranges.pop(target_id, None)
+
+    for key in self.by_target.pop(target_id, ()):
+      delivery = self.entries.pop(key)
+      self.owed.pop(key, None)
+      delivery.waiting.discard(target_id)
+      delivery.fail(target_id)
+      if not delivery.waiting:
+        done.append(delivery)
+
+    return done
+
+  # Fail deliveries whose deadline has passed. Returns completed deliveries.
+  def expire(self):
+    done = []
+    current = now()
+
+    while self.deadlines and self.deadlines[0].deadline <= current:
+      delivery = self.deadlines.popleft()
+      if not delivery.waiting:
+        # Already completed before its deadline
+        continue
+
+      for target_id in delivery.waiting:
+        key = (target_id, delivery.orig_id, delivery.msg_id)
+        if self.entries.get(key) is delivery:
+          del self.entries[key]
+          self.owed.pop(key, None)
+          self.by_target[target_id].discard(key)
+        delivery.fail(target_id)
+        if target_id in self.cumulative:
+          self.trim(target_id, delivery.orig_id)
+      delivery.waiting.clear()
+      done.append(delivery)
+
+    return done
+
+  # Seconds until the earliest deadline, or None if nothing is pending
+  def next_timeout(self):
+    while self.deadlines and not self.deadlines[0].waiting:
+      self.deadlines.popleft()
+
+    if not self.deadlines:
+      return None
+    return max(0, self.deadlines[0].deadline - now())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Pipelined Emitter"""
+
+from __future__ import print_function
+import select
+from codec import OK, ERRO, FLW, BACK, create_msg, following_msg_id
+from codec import stream_frames
+from framing import FrameReader
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+serv_id = (2 ** 16) - 1  # Server id
+
+window = 16  # Default number of messages in flight
+
+# OK as a status byte, which is what bytearray.count takes on Python 2
+ok_status = bytearray((OK,))
+
+#===================================CLASSES===================================#
+
+# A MSG, CREQ or BMSG sent through a pipeline that may still wait for its
+# answer. A BMSG keeps the status of each of its records, and only those that
+# failed are sent again on a retry.
+class Message(object):
+  def __init__(self, msg_type, dest_id, payload, callback, retries):
+    self.type = msg_type
+    self.dest_id = dest_id
+    self.payload = payload
+    self.callback = callback  # Called with the message and whether it was OK
+    self.retries = retries  # How many more times to resend it on ERRO
+    self.msg_id = None  # Id of the last attempt
+    self.attempts = 0
+    self.records = None  # BMSG only: every (dest_id, content) record
+    self.indexes = None  # BMSG only: records sent in the last attempt
+    self.statuses = None  # BMSG only: OK or ERRO for each record
+
+
+# Emitter that keeps up to window messages in flight instead of waiting for
+# the answer of each one before sending the next.
+#
+# Answers are matched with their message by id, so they may come in any
+# order. Ids wrap around after 65535, skipping the ones still in flight, and
+# a message that gets ERRO is sent again under a new id while it has retries
+# left. Its callback runs once, with the final outcome.
+class Pipeline(object):
+  def __init__(self, s, this_id, seq_id=1, window=window):
+    self.s = s
+    self.this_id = this_id
+    self.seq_id = seq_id  # Id of the next message
+    self.window = window
+    self.reader = FrameReader(s)
+    self.in_flight = {}  # msg_id -> Message
+    self.closed = False  # Set once the server shuts down or goes away
+    self.ok = 0
+    self.erro = 0
+    self.retried = 0
+
+  def __len__(self):
+    return len(self.in_flight)
+
+  # Send a message, first waiting for room in the window. Returns the
+  # Message, or None if the connection is already closed.
+  def send(self, msg_type, dest_id, payload=None, callback=None, retries=0):
+    while len(self.in_flight) >= self.window and not self.closed:
+      self.poll(None)
+
+    if self.closed:
+      return None
+
+    message = Message(msg_type, dest_id, payload, callback, retries)
+    self.transmit(message)
+    return message
+
+  # Send several (dest_id, content) records in one BMSG, which the server
+  # must have accepted at OI. The callback gets whether all were delivered,
+  # and the status of each is in the statuses of the Message.
+  def send_batch(self, records, callback=None, retries=0):
+    records = list(records)
+    while len(self.in_flight) >= self.window and not self.closed:
+      self.poll(None)
+
+    if self.closed:
+      return None
+
+    message = Message('BMSG', serv_id, records, callback, retries)
+    message.records = records
+    message.indexes = list(range(len(records)))
+    message.statuses = bytearray(len(records))
+    self.transmit(message)
+    return message
+
+  # Send a payload of any size as a stream of FRAG frames ending in a MSG,
+  # which the server must have accepted at OI. chunks(of up to max_content
+  # bytes each) are read as they are sent, and the answers that arrive in
+  # the meantime are handled. Streams are never sent again, since their
+  # chunks are gone.
+  def send_stream(self, dest_id, chunks, callback=None):
+    while len(self.in_flight) >= self.window and not self.closed:
+      self.poll(None)
+
+    if self.closed:
+      return None
+
+    message = Message('MSG', dest_id, None, callback, 0)
+    msg_id = self.take_id(message)
+    for frame in stream_frames(self.this_id, dest_id, msg_id, chunks):
+      self.s.sendall(frame)
+      self.poll(0)
+      if self.closed:
+        # Server has shut down, the message has already failed
+        break
+    return message
+
+  # Send a message under the next free id
+  def transmit(self, message):
+    msg_id = self.take_id(message)
+    self.s.sendall(create_msg(message.type, self.this_id, message.dest_id,
+                              msg_id, message.payload)[0])
+
+  # Put a message in flight under the next free id, which is returned
+  def take_id(self, message):
+    while self.seq_id in self.in_flight:
+      # Wrapped around onto a message that is still waiting for its answer
+      self.seq_id = following_msg_id(self.seq_id)
+
+    msg_id = self.seq_id
+    message.msg_id = msg_id
+    message.attempts += 1
+    self.in_flight[msg_id] = message
+    self.seq_id = following_msg_id(msg_id)
+    return msg_id
+
+  # Handle the answers that arrive within timeout seconds(None blocks until
+  # at least one does). Returns the number of frames handled.
+  def poll(self, timeout=0):
+    if self.closed:
+      return 0
+
+    readable = select.select([self.s], [], [], timeout)[0]
+    if not readable:
+      return 0
+
+    if not self.reader.fill():
+      # Server is gone without a FLW
+      self.close()
+      return 0
+
+    handled = 0
+    for msg in self.reader.frames():
+      handled += 1
+      if msg['type'] == FLW:
+        # Server is shutting down, answer with OK
+        self.s.sendall(create_msg('OK', self.this_id, serv_id, msg['id'])[0])
+        self.close()
+        break
+      elif msg['type'] in (OK, ERRO):
+        self.answer(msg['id'], msg['type'] == OK)
+      elif msg['type'] == BACK:
+        self.answer_batch(msg['id'], msg['msg'])
+
+    return handled
+
+  # Complete or retry the message with the given id
+  def answer(self, msg_id, ok):
+    message = self.in_flight.pop(msg_id, None)
+    if message is None or message.type == 'FLW':
+      # Not ours, already completed or the answer to shutdown
+      return
+
+    if not ok and message.retries > 0:
+      message.retries -= 1
+      self.retried += 1
+      self.transmit(message)
+      return
+
+    if ok:
+      self.ok += 1
+    else:
+      self.erro += 1
+    if message.callback is not None:
+      message.callback(message, ok)
+
+  # Complete a batch or retry the records that failed
+  def answer_batch(self, msg_id, statuses):
+    message = self.in_flight.pop(msg_id, None)
+    if message is None or message.type != 'BMSG':
+      return
+
+    failed = []
+    for i, status in zip(message.indexes, statuses):
+      message.statuses[i] = status
+      if status != OK:
+        failed.append(i)
+
+    if failed and message.retries > 0:
+      message.retries -= 1
+      self.retried += len(failed)
+      message.indexes = failed
+      message.payload = [message.records[i] for i in failed]
+      self.transmit(message)
+      return
+
+    self.ok += message.statuses.count(ok_status)
+    self.erro += len(message.records) - message.statuses.count(ok_status)
+    if message.callback is not None:
+      message.callback(message, not failed)
+
+  # Wait until every message in flight has been answered
+  def drain(self):
+    while self.in_flight and not self.closed:
+      self.poll(None)
+
+  # Wait for the answers in flight, then disconnect from the server with FLW
+  def shutdown(self):
+    self.drain()
+    if self.closed:
+      return
+
+    flw = Message('FLW', serv_id, None, None, 0)
+    self.transmit(flw)
+    while flw.msg_id in self.in_flight and not self.closed:
+      self.poll(None)
+    self.close()
+
+  # Fail whatever is still in flight and close the socket
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+
+    in_flight = list(self.in_flight.values())
+    self.in_flight.clear()
+    for message in in_flight:
+      if message.type == 'FLW':
+        continue
+      elif message.type == 'BMSG':
+        self.ok += message.statuses.count(ok_status)
+        self.erro += len(message.records) - message.statuses.count(ok_status)
+      else:
+        self.erro += 1
+      if message.callback is not None:
+        message.callback(message, False)
+
+    self.s.close()
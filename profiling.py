@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Profiling Hooks"""
+
+from __future__ import print_function
+import json
+import time
+import signal
+import cProfile
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+clock = getattr(time, "perf_counter", time.time)
+
+#===================================CLASSES===================================#
+
+# Opt-in profiling of the server loop. Functions wrapped with timed add their
+# calls and time under a name, which tells the handlers of each message type
+# and the select wait(idle time) apart.
+#
+# cProfile can be run on top of it, from the start or toggled by a signal.
+# SIGUSR1 writes the timings to path, as JSON, and SIGUSR2 starts cProfile or
+# stops it and writes its stats to path + ".prof", to be read with pstats.
+class Profiler(object):
+  def __init__(self, path):
+    self.path = path
+    self.times = {}  # Name -> [calls, seconds, slowest call in seconds]
+    self.started = clock()
+    self.profile = None  # cProfile.Profile while it runs
+
+  # Wrap function so that its calls are timed under name
+  def timed(self, name, function):
+    entry = self.times.setdefault(name, [0, 0.0, 0.0])
+
+    def wrapper(*args):
+      start = clock()
+      try:
+        return function(*args)
+      finally:
+        elapsed = clock() - start
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+          entry[2] = elapsed
+
+    return wrapper
+
+  # Time every function of a dispatch table, in place
+  def time_handlers(self, handlers):
+    for code, function in handlers.items():
+      handlers[code] = self.timed(function.__name__, function)
+
+  # Have the signals write the timings and toggle cProfile
+  def install_signals(self):
+    if hasattr(signal, "SIGUSR1"):
+      signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+      signal.signal(signal.SIGUSR2,
+                    lambda signum, frame: self.toggle_cprofile())
+
+  # Start cProfile if it isn't running, otherwise stop it and write its stats
+  def toggle_cprofile(self):
+    if self.profile is None:
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+      return
+
+    self.profile.disable()
+    self.profile.dump_stats(self.path + ".prof")
+    self.profile = None
+
+  # Timings so far. Shares are of the time since profiling started.
+  def report(self):
+    wall = clock() - self.started
+    handlers = {}
+    for name, (calls, seconds, slowest) in self.times.items():
+      handlers[name] = {
+        "calls": calls,
+        "seconds": seconds,
+        "mean_us": seconds * 1e6 / calls if calls else 0,
+        "max_us": slowest * 1e6,
+        "share": seconds / wall if wall else 0,
+      }
+
+    return {"wall_seconds": wall, "handlers": handlers}
+
+  # Write the timings, and the cProfile stats if it is running
+  def dump(self):
+    with open(self.path, "w") as f:
+      json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    if self.profile is not None:
+      self.profile.dump_stats(self.path + ".prof")
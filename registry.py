@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Client Registry"""
+
+from __future__ import print_function
+from array import array
+from bisect import bisect_left
+from codec import length
+from id_pool import IdAllocator
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+no_members = frozenset()  # Members of a group nobody has joined
+
+#===================================CLASSES===================================#
+
+# Every connected client, the emitter/exhibitor pairs between them and the
+# multicast groups exhibitors joined. Keeps the forward and reverse maps
+# consistent so that lookups are O(1). Adding and removing a client are
+# linear in the number of clients, since they also shift the sorted ids and
+# the CLIST payload.
+#
+# The CLIST payload is kept encoded as well. Ids are inserted into and
+# removed from it in sorted position as clients come and go, and a copy is
+# only taken when it is requested after membership has changed.
+class ClientRegistry(object):
+  def __init__(self, lowest_first=True):
+    self.pools = {
+      "emitter": IdAllocator(1, 2 ** 12 - 1, lowest_first),
+      "exhibitor": IdAllocator(2 ** 12, 2 ** 13 - 1, lowest_first),
+    }
+    self.id_to_conn = {}  # client id -> connection
+    self.id_to_type = {}  # client id -> "emitter" or "exhibitor"
+    self.conn_to_id = {}  # connection -> client id
+    self.emi_to_exh = {}  # emitter id -> associated exhibitor id
+    self.exh_to_emi = {}  # exhibitor id -> associated emitter id
+    self.exhibitor_ids = set()  # Ids of every exhibitor, for broadcasts
+    self.groups = {}  # group id -> ids of its exhibitors, for multicasts
+    self.memberships = {}  # exhibitor id -> ids of the groups it joined
+    self.sorted_ids = array('H')  # Every client id, in ascending order
+    self.clist = bytearray(length.pack(0))  # Encoded CLIST payload
+    self.version = 0  # Incremented whenever membership changes
+    self.clist_cache = (-1, None)  # (version, payload) last handed out
+
+  def __contains__(self, client_id):
+    return client_id in self.id_to_conn
+
+  def __len__(self):
+    return len(self.id_to_conn)
+
+  def __iter__(self):
+    return iter(self.id_to_conn)
+
+  # Register a client connection under the given id
+  def add(self, client_id, conn, client_type):
+    self.id_to_conn[client_id] = conn
+    self.id_to_type[client_id] = client_type
+    self.conn_to_id[conn] = client_id
+    if client_type == "exhibitor":
+      self.exhibitor_ids.add(client_id)
+
+    # Insert the id into the sorted ids and the encoded payload
+    i = bisect_left(self.sorted_ids, client_id)
+    self.sorted_ids.insert(i, client_id)
+    offset = length.size * (i + 1)
+    self.clist[offset:offset] = length.pack(client_id)
+    length.pack_into(self.clist, 0, len(self.sorted_ids))
+    self.version += 1
+
+  # Take a free id for a new client of the given type. Returns -1 if there
+  # is none left.
+  def allocate(self, client_type):
+    return self.pools[client_type].allocate()
+
+  # Number of ids still free for the given client type
+  def available(self, client_type):
+    return len(self.pools[client_type])
+
+  # Returns True if the given client type has just run low on free ids
+  def running_low(self, client_type):
+    return self.pools[client_type].reached_low_water()
+
+  # Forget a client and any pair it was part of, freeing its id
+  def remove(self, client_id):
+    conn = self.id_to_conn.pop(client_id)
+    client_type = self.id_to_type.pop(client_id)
+    del self.conn_to_id[conn]
+    self.exhibitor_ids.discard(client_id)
+    self.pools[client_type].release(client_id)
+
+    # Take the id out of the sorted ids and the encoded payload
+    i = bisect_left(self.sorted_ids, client_id)
+    del self.sorted_ids[i]
+    offset = length.size * (i + 1)
+    del self.clist[offset:offset + length.size]
+    length.pack_into(self.clist, 0, len(self.sorted_ids))
+    self.version += 1
+
+    exhibitor_id = self.emi_to_exh.pop(client_id, None)
+    if exhibitor_id is not None:
+      # Client had an exhibitor assigned to it
+      del self.exh_to_emi[exhibitor_id]
+
+    emitter_id = self.exh_to_emi.pop(client_id, None)
+    if emitter_id is not None:
+      # Client had an emitter assigned to it
+      del self.emi_to_exh[emitter_id]
+
+    for group_id in list(self.memberships.get(client_id, ())):
+      self.leave(group_id, client_id)
+
+  # Associate an emitter with an exhibitor
+  def pair(self, emitter_id, exhibitor_id):
+    self.emi_to_exh[emitter_id] = exhibitor_id
+    self.exh_to_emi[exhibitor_id] = emitter_id
+
+  # Dissolve the pair of an emitter. Returns the exhibitor id, if any.
+  def unpair(self, emitter_id):
+    exhibitor_id = self.emi_to_exh.pop(emitter_id, None)
+    if exhibitor_id is not None:
+      del self.exh_to_emi[exhibitor_id]
+    return exhibitor_id
+
+  # Add an exhibitor to a group
+  def join(self, group_id, exhibitor_id):
+    self.groups.setdefault(group_id, set()).add(exhibitor_id)
+    self.memberships.setdefault(exhibitor_id, set()).add(group_id)
+
+  # Take an exhibitor out of a group. Returns False if it wasn't in it.
+  def leave(self, group_id, exhibitor_id):
+    members = self.groups.get(group_id)
+    if not members or exhibitor_id not in members:
+      return False
+
+    members.remove(exhibitor_id)
+    if not members:
+      del self.groups[group_id]
+    joined = self.memberships[exhibitor_id]
+    joined.remove(group_id)
+    if not joined:
+      del self.memberships[exhibitor_id]
+    return True
+
+  # Ids of the exhibitors in a group
+  def members(self, group_id):
+    return self.groups.get(group_id, no_members)
+
+  # Connection of a client, None if not connected
+  def conn(self, client_id):
+    return self.id_to_conn.get(client_id)
+
+  # Id of the client on a connection, None if it hasn't finished OI
+  def id_of(self, conn):
+    return self.conn_to_id.get(conn)
+
+  # Returns True if client is an emitter
+  def is_emitter(self, client_id):
+    return self.id_to_type.get(client_id) == "emitter"
+
+  # Returns True if client is an exhibitor
+  def is_exhibitor(self, client_id):
+    return self.id_to_type.get(client_id) == "exhibitor"
+
+  # Payload of a CLIST message listing every connected client
+  def clist_payload(self):
+    if self.clist_cache[0] != self.version:
+      self.clist_cache = (self.version, bytes(self.clist))
+    return self.clist_cache[1]
+
+  # Ids of every connected exhibitor
+  def exhibitors(self):
+    return self.exhibitor_ids
+
+  # Exhibitor associated with an emitter, None if there is none
+  def exhibitor_of(self, emitter_id):
+    return self.emi_to_exh.get(emitter_id)
+
+  # Emitter associated with an exhibitor, None if there is none
+  def emitter_of(self, exhibitor_id):
+    return self.exh_to_emi.get(exhibitor_id)
+
+  # Check if a connection and an id point to the same client
+  def check_identity(self, client_id, conn):
+    return self.conn_to_id.get(conn) == client_id
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Select-based Selector"""
+
+from __future__ import print_function
+import errno
+import select
+from collections import namedtuple
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+EVENT_READ = 1  # Socket has data to be read
+EVENT_WRITE = 2  # Socket can take more data
+
+# What a registered socket is waited for, along with the state kept with it
+SelectorKey = namedtuple("SelectorKey", "fileobj fd events data")
+
+#===================================CLASSES===================================#
+
+# The part of the selectors interface the servers and the benchmark use, on
+# top of select() for Python 2 without the selectors2 backport. select() only
+# takes descriptors under FD_SETSIZE(1024 on Linux), which caps the clients
+# that can be connected.
+class SelectSelector(object):
+  def __init__(self):
+    self.keys = {}  # File descriptor -> key of the socket registered with it
+
+  # Descriptor fileobj was registered with, even if it has been closed since
+  def find(self, fileobj):
+    try:
+      fd = fileobj.fileno()
+    except (AttributeError, ValueError, OSError, IOError):
+      fd = -1
+    key = self.keys.get(fd)
+    if key is not None and key.fileobj is fileobj:
+      return fd
+    for fd, key in self.keys.items():
+      if key.fileobj is fileobj:
+        return fd
+    raise KeyError("{!r} is not registered".format(fileobj))
+
+  def register(self, fileobj, events, data=None):
+    fd = fileobj.fileno()
+    if fd in self.keys:
+      raise KeyError("{!r} is already registered".format(fileobj))
+    key = SelectorKey(fileobj, fd, events, data)
+    self.keys[fd] = key
+    return key
+
+  def unregister(self, fileobj):
+    return self.keys.pop(self.find(fileobj))
+
+  def modify(self, fileobj, events, data=None):
+    fd = self.find(fileobj)
+    key = self.keys[fd]._replace(events=events, data=data)
+    self.keys[fd] = key
+    return key
+
+  # Keys of the sockets that are ready, along with the events they are ready
+  # for. A signal cutting the wait short returns nothing.
+  def select(self, timeout=None):
+    if timeout is not None:
+      timeout = max(timeout, 0)
+    readers = [fd for fd, key in self.keys.items() if key.events & EVENT_READ]
+    writers = [fd for fd, key in self.keys.items()
+               if key.events & EVENT_WRITE]
+    try:
+      readable, writable = select.select(readers, writers, [], timeout)[:2]
+    except (select.error, OSError) as e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+
+    ready = {}  # File descriptor -> events it is ready for
+    for fd in readable:
+      ready[fd] = EVENT_READ
+    for fd in writable:
+      ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+    return [(self.keys[fd], events) for fd, events in ready.items()
+            if fd in self.keys]
+
+  def close(self):
+    self.keys.clear()
+
+
+DefaultSelector = SelectSelector
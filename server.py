@@ -7,15 +7,39 @@ from __future__ import print_function
 import sys
 import socket
 import struct
-import select
+import argparse
 import server_utils as utils
+import connection
+import logger
+import options
+from metrics import stats, earliest
+from profiling import Profiler
+from connection import Connection, selectors
+from registry import ClientRegistry
+from pending import PendingTable
 
 __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
 #====================================MAIN=====================================#
 
+parser = argparse.ArgumentParser(description=__doc__)
+options.add_server_options(parser)
+parser.add_argument("--no-coalesce", action="store_true", 
+                    help="write every frame as soon as it is sent instead of "
+                         "gathering each client's frames into a single write "
+                         "per loop iteration")
+parser.add_argument("--profile", metavar="FILE", 
+                    help="time every message handler and the select wait, "
+                         "writing the timings to FILE on SIGUSR1 and on exit. "
+                         "SIGUSR2 toggles cProfile, whose stats go to "
+                         "FILE.prof")
+parser.add_argument("--cprofile", action="store_true", 
+                    help="with --profile, run cProfile from the start")
+args = parser.parse_args()
+options.configure(parser, args)
+
 HOST = ""
-PORT = int(sys.argv[1])
+PORT = args.port
 ADDR = (HOST, PORT)
 
 # Creates socket that will manage connections to the server
@@ -24,39 +48,91 @@ server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 # Prevents "Address already in use" error
 server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
 
+# Allow a file descriptor for every id the protocol can assign
+utils.raise_fd_limit(utils.max_clients)
+
 # Set socket server to listen at given address
 server.bind(ADDR)
-server.listen(1)
+server.listen(socket.SOMAXCONN)
 
 print("Server is now listening on port ", PORT, ".", sep="")
 
-conn_socks = [server]  # Connected Sockets. Server is "connected" to itself
-id_to_sock = {}  # Dictionary that maps client ids to (socket, type)
-emi_to_exh = {}  # Dictionary that maps emitters to exhibitors
+sel = selectors.DefaultSelector()  # Every socket, with its connection state
+sel.register(server, selectors.EVENT_READ, None)  # Server has no state
+# Connected clients and emitter/exhibitor pairs
+registry = ClientRegistry(args.id_order == "lowest")
+pending = PendingTable(args.ack_timeout)  # Deliveries waiting for an answer
+
+select = sel.select
+profiler = None
+if args.profile:
+  # Time the wait for events apart from the work done on them
+  profiler = Profiler(args.profile)
+  profiler.time_handlers(utils.handlers)
+  select = profiler.timed("select", sel.select)
+  profiler.install_signals()
+  if args.cprofile:
+    profiler.toggle_cprofile()
 
 while True:
   try:
-    readable, writable, exceptional = select.select(conn_socks, [], [])
-    for s in readable:  
-      if s is server:
+    timeout = earliest(pending.next_timeout(), stats.next_timeout())
+    for key, mask in select(timeout):
+      s = key.data
+      if s is None:
         # A client has requested a connection
-        client_socket, client_address = s.accept()
-        conn_socks.append(client_socket)
-        print("[LOG] Client", client_address, "is now connected.")
-      else:
-        msg = utils.receive_msg(s)
-        if msg:
-          # Process received message according to its type
-          utils.process_msg(msg, s, conn_socks, id_to_sock, emi_to_exh)
-        else:
+        client_socket, client_address = server.accept()
+        Connection(client_socket, sel, args.high_water, args.low_water,
+                   not args.no_coalesce)
+        logger.log(logger.LOG, "connect", "Client {} is now connected.", 
+                   client_address)
+        continue
+      elif s.closed:
+        # Connection was closed while handling another socket
+        continue
+
+      if mask & selectors.EVENT_WRITE:
+        # Socket can take more of the data that didn't fit before
+        s.flush()
+
+      if mask & selectors.EVENT_READ:
+        if not s.read():
           # A client has closed the connection
-          utils.kill_client(s, "con_dead", conn_socks, id_to_sock, emi_to_exh)
-  except KeyboardInterrupt:
-    # Send FLW to every connected client, wait for OK and close all connections
-    utils.broadcast_FLW(conn_socks, id_to_sock, emi_to_exh)
+          utils.kill_client(s, "con_dead", sel, registry, pending)
+          continue
+
+        for msg in s.frames():
+          # Process received message according to its type
+          utils.process_msg(msg, s, sel, registry, pending)
+          if s.closed:
+            # Client has been killed while processing its messages
+            break
 
-    # Close connection handling socket
+    # Answer ERRO for messages whose exhibitors didn't acknowledge in time
+    utils.expire_pending(sel, registry, pending)
+    # Forward kept messages to the clients that connected or caught up
+    utils.drain_store(sel, registry, pending)
+    # Everything each client was sent in this iteration goes in one write
+    connection.write_gathered()
+    if connection.broken:
+      # Peers found gone while writing to them. Killing them may send more.
+      utils.kill_broken(sel, registry, pending)
+      connection.write_gathered()
+    stats.report(registry, pending)
+    logger.flush()
+  except KeyboardInterrupt:
+    # Stop accepting new connections
+    sel.unregister(server)
     server.close()
 
+    # Send FLW to every connected client, wait for OK and close all connections
+    utils.broadcast_FLW(sel, registry, pending)
+    sel.close()
+    if utils.store is not None:
+      utils.store.close()
+    logger.close()
+    if profiler:
+      profiler.dump()
+
     # End program
-    sys.exit()
\ No newline at end of file
+    sys.exit()
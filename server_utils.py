@@ -4,8 +4,14 @@
 """Messaging System Server Utility Functions"""
 
 from __future__ import print_function
+import json
 import socket
-import struct
+import codec
+import logger
+from codec import create_msg
+from pending import Delivery, now
+from metrics import stats
+from connection import selectors, write_gathered, broken
 
 __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
@@ -13,149 +19,352 @@ __author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
 
 serv_id = (2 ** 16) - 1 # Server id to use as source on messages
 
-#===================================METHODS===================================#
-
-# Create and pack a message with the parameters
-def create_msg(msg_type, orig_id, dest_id, msg_id, payload=None):
-  type_to_int = {
-    'OK': 1, 
-    'ERRO': 2, 
-    'OI': 3, 
-    'FLW': 4, 
-    'MSG': 5, 
-    'CREQ': 6,
-    'CLIST': 7, 
-  }
-
-  next_msg_id = msg_id
-
-  if msg_type != 'OK' and msg_type != 'ERRO':
-    next_msg_id += 1
-
-  converted_type = struct.pack("!H", type_to_int[msg_type])
-  orig_id = struct.pack("!H", orig_id)
-  dest_id = struct.pack("!H", dest_id)
-  msg_id = struct.pack("!H", msg_id)
-
-  msg = converted_type + orig_id + dest_id + msg_id
-
-  if msg_type == 'MSG':
-    c = struct.pack("!H", len(payload))
-    msg += c + payload
-  elif msg_type == 'CLIST':
-    msg += payload
-
-  return msg, next_msg_id
-
-
-# Generate and return the payload for the CLIST message
-def create_clist_payload(id_to_sock):
-  n = 0  # Number of connected clients
-  client_ids = [] 
-
-  for client_id in id_to_sock:
-    client_ids.append(client_id)
-    n += 1
-
-  client_ids.sort()
-  clients = ""
-  for client in client_ids:
-    clients += struct.pack("!H", client)
-
-  return struct.pack("!H", n) + clients
+max_clients = (2 ** 13) - 1  # 4095 emitters and 4096 exhibitors
+
+# What to do with a message for a client that isn't keeping up with what it
+# is sent: "drop" it for that client only(broadcasts still succeed without
+# it), answer "erro" to the emitter, "disconnect" the slow client or "store"
+# it to be forwarded once the client catches up(MSG and ZMSG to a single
+# target only, the rest are answered ERRO)
+slow_consumer = "erro"
+
+# Log where MSG and ZMSG frames for clients that can't take them yet are kept
+# until they can, None if store-and-forward is disabled
+store = None
+
+# Level and message logged when a client is killed, for each reason
+kill_logs = {
+  "bad_id": (logger.ERROR, "Client {} has been killed due to bad identity "
+                           "credentials."),
+  "oi_fail": (logger.ERROR, "Client {} has been disconnected due to fail on "
+                            "connection setup."),
+  "flw_msg": (logger.LOG, "Client {} has been disconnected: FLW."),
+  "slow": (logger.ERROR, "Client {} has been disconnected for not keeping up "
+                         "with its messages."),
+  "con_dead": (logger.LOG, "Client {} has been disconnected."),
+  "bad_type": (logger.ERROR, "Client {} has been killed for sending a message "
+                             "of a type the server doesn't handle."),
+}
+
+# Client capabilities this server accepts at OI
+supported_caps = (codec.CAP_BATCH | codec.CAP_CUMULATIVE | codec.CAP_STREAM |
+                  codec.CAP_ZLIB)
+
+# Streams being relayed. Maps the origin of each to {msg_id: (target_id,
+# connection)}, or None instead of the pair if the stream was refused.
+streams = {}
+
+#===================================CLASSES===================================#
+
+# Frame of a ZMSG for each target, built the first time it is asked for: the
+# frame as received for exhibitors that asked for compression, and a MSG with
+# the payload decompressed(only once, for all of them) for the rest. None for
+# the rest if the payload can't be decompressed into a MSG.
+class CompressedFrames(dict):
+  def __init__(self, msg, registry):
+    dict.__init__(self)
+    self.msg = msg
+    self.registry = registry
+    self.plain = None  # MSG frame, once decompressed
+    self.invalid = False
+
+  def __missing__(self, target_id):
+    if self.registry.conn(target_id).caps & codec.CAP_ZLIB:
+      return self.msg['frame']
+
+    if self.plain is None and not self.invalid:
+      payload = codec.decompress_payload(self.msg['msg'])
+      if payload is None:
+        self.invalid = True
+        logger.log(logger.ERROR, "zmsg", "Message {} from client {} couldn't "
+                   "be decompressed.", self.msg['id'], self.msg['orig_id'])
+      else:
+        self.plain = create_msg('MSG', self.msg['orig_id'],
+                                self.msg['dest_id'], self.msg['id'],
+                                payload)[0]
+    return self.plain
 
+#===================================METHODS===================================#
 
-# Send message and process the received response
-def deliver_msg(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  s.send(msg)
-  # Receive confirmation
-  response = receive_msg(s)
-  process_msg(response, s, conn_socks, id_to_sock, emi_to_exh)
+# Raise the soft limit of open files so every client can have a socket. Some
+# spare descriptors are left for the server socket and standard streams.
+def raise_fd_limit(clients):
+  try:
+    import resource
+  except ImportError:
+    # Not available on this platform
+    return
+
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  wanted = clients + 64
+  if hard != resource.RLIM_INFINITY:
+    wanted = min(wanted, hard)
+  if soft != resource.RLIM_INFINITY and soft < wanted:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+# Return the payload for the CLIST message, kept up to date by the registry
+def create_clist_payload(registry):
+  return registry.clist_payload()
+
+
+# Type of an encoded frame, or of the first of a list of buffers
+def frame_type(frame):
+  if isinstance(frame, list):
+    frame = frame[0]
+  return codec.length.unpack_from(frame)[0]
+
+
+# Send message to the targets and register them as pending. Doesn't block on
+# the answers, which are matched by process_OK/process_ERRO when they arrive.
+# The message is encoded once by the caller, either as a single buffer or as
+# a list of buffers that are gathered on every send, or is a dictionary with
+# the message of each target(None for those it can't be sent to). answers is
+# passed on to the pending table.
+def deliver_msg(msg, targets, delivery, sel, registry, pending, answers=None):
+  sent = []
+  slow = []
+  # Answers to batches and to the server can't wait for the log
+  keep = (slow_consumer == "store" and store is not None and
+          not delivery.broadcast and delivery.on_done is None)
+
+  for target_id in targets:
+    conn = registry.conn(target_id)
+    frame = msg[target_id] if isinstance(msg, dict) else msg
+    if frame is None:
+      delivery.fail(target_id)
+    elif (keep and (conn.congested or target_id in store) and
+          keep_frame(frame, target_id)):
+      # Forwarded once the target catches up, after what it already has kept
+      continue
+    elif conn.congested:
+      # Its outbound queue is full, apply the slow consumer policy
+      slow.append(target_id)
+    elif isinstance(frame, list):
+      conn.sendv(frame)
+      sent.append(target_id)
+    else:
+      conn.send(frame)
+      sent.append(target_id)
+
+  if isinstance(msg, dict):
+    # Targets may have been sent different types
+    for target_id in sent:
+      stats.count_sent(frame_type(msg[target_id]))
+  elif sent:
+    stats.count_sent(frame_type(msg), len(sent))
+
+  if slow_consumer != "drop" or not delivery.broadcast:
+    # Only broadcasts can leave a client out and still succeed
+    for target_id in slow:
+      delivery.fail(target_id)
+
+  if pending.add(delivery, sent, answers):
+    # Nobody to wait for
+    finish_delivery(delivery, sel, registry, pending)
+
+  for target_id in slow:
+    logger.log(logger.ERROR, "slow", "Client {} is not keeping up: message {} "
+               "from client {} refused.", target_id, delivery.msg_id,
+               delivery.orig_id)
+    if slow_consumer == "disconnect" and target_id in registry:
+      kill_client(registry.conn(target_id), "slow", sel, registry, pending)
+
+
+# Send message to every exhibitor connected(or only to targets, the members
+# of a group) without waiting for the answers. Their acknowledgements are
+# collected into a single answer to the emitter.
+def deliver_broadcast(msg, delivery, sel, registry, pending, targets=None):
+  if targets is None:
+    targets = registry.exhibitors()
+
+  delivery.broadcast = True
+  stats.fanout.add(len(targets))
+  deliver_msg(msg, targets, delivery, sel, registry, pending)
+
+
+# Answer the client that originated a delivery once every target answered
+def finish_delivery(delivery, sel, registry, pending):
+  if delivery.targets:
+    # Forwarded at the deadline minus the timeout
+    stats.ack_rtt.add((now() - delivery.deadline + pending.timeout) * 1e6)
+
+  if delivery.on_done:
+    delivery.on_done(delivery)
+    return
+
+  if delivery.broadcast:
+    logger.log(logger.TRACE, "broadcast", "Broadcast {} from client {} was "
+               "acknowledged by {} of {} exhibitors.", delivery.msg_id,
+               delivery.orig_id, delivery.acked(), delivery.targets)
+
+  if not registry.check_identity(delivery.orig_id, delivery.s):
+    # Emitter has disconnected in the meantime
+    return
+
+  if delivery.succeeded():
+    send_OK(delivery.s, serv_id, delivery.orig_id, delivery.msg_id)
+  else:
+    send_ERRO(delivery.s, serv_id, delivery.orig_id, delivery.msg_id)
 
 
-# Send message to every exhibitor connected and process the received response
-def deliver_broadcast(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  for client_id in id_to_sock:
-    if id_to_sock[client_id][1] == "exhibitor":
-      exhibitor_socket = id_to_sock[client_id][0]
-      deliver_msg(msg, exhibitor_socket, conn_socks, id_to_sock, emi_to_exh)
+# Answer every delivery whose acknowledgement deadline has passed
+def expire_pending(sel, registry, pending):
+  for delivery in pending.expire():
+    logger.log(logger.ERROR, "expired", "Message {} from client {} was not "
+               "acknowledged in time.", delivery.msg_id, delivery.orig_id)
+    finish_delivery(delivery, sel, registry, pending)
 
 
-# Send OK message to given socket and print LOG
+# Send OK message to given socket and log it
 def send_OK(s, orig_id, dest_id, msg_id):
-  print("[LOG] Sending OK message to client ", dest_id, ".", sep = "")
+  logger.log(logger.TRACE, "send_ok", "Sending OK message to client {}.",
+             dest_id)
+  stats.count_sent(codec.OK)
   s.send(create_msg('OK', orig_id, dest_id, msg_id)[0])
 
 
-# Send ERRO message to given socket and print LOG
+# Send ERRO message to given socket and log it
 def send_ERRO(s, orig_id, dest_id, msg_id):
-  print("[LOG] Sending ERRO message to client ", dest_id, ".", sep = "")
+  logger.log(logger.TRACE, "send_erro", "Sending ERRO message to client {}.",
+             dest_id)
+  stats.count_sent(codec.ERRO)
   s.send(create_msg('ERRO', orig_id, dest_id, msg_id)[0])
 
 
 # Send message to id. In case of emitter, if possible, redirects to exhibitor.
-def send_to_id(msg, s, orig_msg, conn_socks, id_to_sock, emi_to_exh):
+# The sender is answered later, once the exhibitors acknowledge the message.
+def send_to_id(msg, s, orig_msg, sel, registry, pending):
+  delivery = Delivery(s, orig_msg['orig_id'], orig_msg['id'])
+
   if orig_msg['dest_id'] == 0:
     # Broadcast message
-    deliver_broadcast(msg, s, conn_socks, id_to_sock, emi_to_exh)
+    deliver_broadcast(msg, delivery, sel, registry, pending)
+    return True
+
+  elif codec.is_group(orig_msg['dest_id']):
+    # Multicast message, only for the exhibitors in the group
+    deliver_broadcast(msg, delivery, sel, registry, pending,
+                      registry.members(orig_msg['dest_id']))
     return True
 
-  elif orig_msg['dest_id'] in id_to_sock:
+  elif orig_msg['dest_id'] in registry:
     # Target client exists
-    if is_exhibitor(orig_msg['dest_id'], id_to_sock):
+    if registry.is_exhibitor(orig_msg['dest_id']):
       # Target is an exhibitor
 
       # Send message to exhibitor
-      exhibitor_socket = id_to_sock[orig_msg['dest_id']][0]
-      deliver_msg(msg, exhibitor_socket, conn_socks, id_to_sock, emi_to_exh)
+      targets = [orig_msg['dest_id']]
+      deliver_msg(msg, targets, delivery, sel, registry, pending)
       return True
 
-    elif has_exhibitor(orig_msg['dest_id'], emi_to_exh):
+    elif registry.exhibitor_of(orig_msg['dest_id']) is not None:
       # Target is emitter but have an exhibitor associated
 
       # Redirects message to associated exhibitor
-      exhibitor_id = emi_to_exh[orig_msg['dest_id']]
-      exhibitor_socket = id_to_sock[exhibitor_id][0]
-      deliver_msg(msg, exhibitor_socket, conn_socks, id_to_sock, emi_to_exh)
+      targets = [registry.exhibitor_of(orig_msg['dest_id'])]
+      deliver_msg(msg, targets, delivery, sel, registry, pending)
       return True
 
     else:
       # Target is an emitter with no associated exhibitor
-      print("[ERROR] Target is an emitter with no associated exhibitor.")
+      logger.log(logger.ERROR, "no_target", "Target is an emitter with no "
+                 "associated exhibitor.")
       return False
 
+  elif keep_msg(orig_msg, s):
+    return True
+
   else:
     # Target is not a client
-    print("[ERROR] Target is not a client.")
+    logger.log(logger.ERROR, "no_target", "Target is not a client.")
     return False
 
 
-# Receives and split message, saving it to a dictionary 
-def receive_msg(s):
-  msg = {}
-  msg_type = s.recv(2)
+# Keep a MSG or ZMSG for an exhibitor that isn't connected yet, answering OK
+# right away since the server is now in charge of it. Returns False if it
+# can't be kept. Emitters only get messages through the exhibitor they are
+# paired with at OI, so what is sent to one that isn't connected could never
+# be delivered.
+def keep_msg(orig_msg, s):
+  if (store is None or orig_msg['type'] not in (codec.MSG, codec.ZMSG) or
+      not 2 ** 12 <= orig_msg['dest_id'] < 2 ** 13):
+    return False
 
-  if msg_type:
-    msg['type'] = struct.unpack("!H", msg_type)[0]
-    msg['orig_id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['dest_id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['id'] = struct.unpack("!H", s.recv(2))[0]
-    msg['msg'] = None
+  if not keep_frame(orig_msg['frame'], orig_msg['dest_id']):
+    return False
 
-    if msg['type'] == 5:
-      # Message has type MSG and has content. Get size of content.
-      content_size = struct.unpack("!H", s.recv(2))[0] 
-      msg['msg'] = s.recv(content_size)
+  logger.log(logger.TRACE, "keep", "Message {} from client {} is kept until "
+             "client {} can take it.", orig_msg['id'], orig_msg['orig_id'],
+             orig_msg['dest_id'])
+  send_OK(s, serv_id, orig_msg['orig_id'], orig_msg['id'])
+  return True
 
-    return msg
 
-  else:
-    # Empty message has been received. Client has disconnected.
-    return None
+# Append a MSG or ZMSG frame to the log under the id it is kept for. Returns
+# False if it isn't one of them or the log is full.
+def keep_frame(frame, kept_id):
+  if isinstance(frame, list) or frame_type(frame) not in (codec.MSG,
+                                                          codec.ZMSG):
+    return False
+
+  if not store.append(kept_id, frame):
+    logger.log(logger.ERROR, "store_full", "No room left to keep messages "
+               "for client {}.", kept_id)
+    return False
+  return True
+
+
+# Forward what is kept for the exhibitors that can take it now, those
+# connected that aren't congested. Called after every batch of events, so
+# they get it as soon as they connect or catch up. Emitters were answered
+# when their messages were kept, so frames stay in the log until the
+# exhibitor acknowledges them, and are forwarded again if it never does.
+def drain_store(sel, registry, pending):
+  if not store:
+    return
+
+  for target_id in store.targets():
+    if not registry.is_exhibitor(target_id):
+      continue
+
+    # One frame at a time, since any of them may congest the target
+    conn = registry.conn(target_id)
+    while target_id in store and not conn.congested and not conn.closed:
+      entry, frame = store.take(target_id)
+      forward_kept(frame, entry, target_id, sel, registry, pending)
+
+
+# Forward a frame taken from the log to an exhibitor. It is released from the
+# log once acknowledged or refused with ERRO, and handed out again otherwise.
+def forward_kept(frame, entry, target_id, sel, registry, pending):
+  msg = {'frame': frame, 'msg': memoryview(frame)[codec.msg_header.size:]}
+  msg_type, msg['orig_id'], msg['dest_id'], msg['id'] = codec.decode_header(
+    frame)
+  if msg_type == codec.ZMSG:
+    frame = CompressedFrames(msg, registry)[target_id]
+
+  def kept_done(delivery):
+    if delivery.failed_ids - delivery.refused_ids:
+      # Timed out, or the exhibitor is gone
+      logger.log(logger.WARNING, "kept_retry", "Kept message {} from client "
+                 "{} was not acknowledged, keeping it.", delivery.msg_id,
+                 delivery.orig_id)
+      store.retry(target_id, entry)
+      return
+
+    if delivery.refused_ids:
+      logger.log(logger.ERROR, "kept_fail", "Kept message {} from client {} "
+                 "was refused.", delivery.msg_id, delivery.orig_id)
+    store.ack(entry)
+
+  delivery = Delivery(None, msg['orig_id'], msg['id'], kept_done)
+  deliver_msg({target_id: frame}, [target_id], delivery, sel, registry,
+              pending)
 
 
 # Tries to add new client and maybe link two of them
-def add_client(s, orig_id, id_to_sock, emi_to_exh):
+def add_client(s, orig_id, registry):
   client_type = ""
   associated_id = None
 
@@ -164,258 +373,505 @@ def add_client(s, orig_id, id_to_sock, emi_to_exh):
   else:
     client_type = "emitter"
 
-  client_id = get_free_id(client_type, id_to_sock)
-
-  if client_id == -1:
-    # Couldn't find a free id for that client
-    print("[ERROR] Couldn't accept new client: All ids are occupied.")
-    return None
-
-  id_to_sock[client_id] = (s, client_type)  # Maps id to socket
-
   if 2 ** 12 <= orig_id < 2 ** 13:
-    # Emitter(client_id) wants to be associated to an exhibitor(orig_id)
-    if orig_id in id_to_sock and orig_id not in emi_to_exh.values():
+    # Emitter wants to be associated to an exhibitor(orig_id)
+    if (registry.is_exhibitor(orig_id) and 
+        registry.emitter_of(orig_id) is None):
       # Exhibitor exists and is not associated to anyone yet
-      emi_to_exh[client_id] = orig_id 
       associated_id = orig_id
     else:
-      print("[ERROR] Couldn't accept new client: Emitter tried to link with an"
-             " invalid exhibitor.")
+      logger.log(logger.ERROR, "oi_fail", "Couldn't accept new client: Emitter "
+                 "tried to link with an invalid exhibitor.")
       return None
 
-  print("[LOG] New", client_type, "with id", client_id, "has been assigned.")
-  if associated_id:
-    print("[LOG] Exhibitor ", associated_id, " is now associated with emitter "
-          , client_id, ".", sep = "") 
-  return client_id
+  client_id = get_free_id(client_type, registry)
 
+  if client_id == -1:
+    # Couldn't find a free id for that client
+    logger.log(logger.ERROR, "oi_fail", "Couldn't accept new client: All ids "
+               "are occupied.")
+    return None
 
-# Remove client from mappings(id_to_sock and emi_to_exh)
-def remove_client(client_id, id_to_sock, emi_to_exh):
-  del id_to_sock[client_id]
-
-  if client_id in emi_to_exh:
-    # Client had an exhibitor assigned to it
-    del emi_to_exh[client_id]
+  registry.add(client_id, s, client_type)  # Maps id to connection
+  if associated_id:
+    registry.pair(client_id, associated_id)
 
-  elif client_id in emi_to_exh.values():
-    # Client had an emitter assigned to it. Get emitter key and remove entry.
-    key = emi_to_exh.keys()[emi_to_exh.values().index(client_id)]
-    del emi_to_exh[key]
+  logger.log(logger.LOG, "new_client", "New {} with id {} has been assigned.",
+             client_type, client_id)
+  if associated_id:
+    logger.log(logger.LOG, "pair", "Exhibitor {} is now associated with "
+               "emitter {}.", associated_id, client_id)
+  return client_id
 
 
 # Finds and return a free id to assign to a new client
-def get_free_id(client_type, id_to_sock):
-  free_id = -1
-
-  if client_type == "emitter":
-    for i in range(1, 2 ** 12):
-      if i not in id_to_sock:
-        free_id = i
-        break
+def get_free_id(client_type, registry):
+  free_id = registry.allocate(client_type)
 
-  elif client_type == "exhibitor":
-    for i in range(2 ** 12, 2 ** 13):
-      if i not in id_to_sock:
-        free_id = i
-        break
+  if free_id != -1 and registry.running_low(client_type):
+    logger.log(logger.WARNING, "ids_low", "Only {} {} ids are left.",
+               registry.available(client_type), client_type)
 
   return free_id
 
 
-# Get the client id for a given socket object
-def get_socket_id(s, id_to_sock):
-  for client_id, client_info in id_to_sock.iteritems():
-    if client_info[0] == s:
-      return client_id
-  return None
-
-
-# Returns True if client is an emitter
-def is_emitter(client_id, id_to_sock):
-  return id_to_sock[client_id][1] == "emitter"
-
+# Process every message received by the server by calling sub process functions
+def process_msg(msg, s, sel, registry, pending):
+  process = handlers.get(msg['type'])
 
-# Returns True if client is an exhibitor
-def is_exhibitor(client_id, id_to_sock):
-  return id_to_sock[client_id][1] == "exhibitor" 
+  args = (msg, s, sel, registry, pending)
+  start = now()
+  stats.received[msg['type']] = stats.received.get(msg['type'], 0) + 1
 
+  if process is None:
+    # Unknown type, or one only clients receive. Its frame may not even have
+    # been split where it ends.
+    send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+    kill_client(s, "bad_type", sel, registry, pending)
+  elif msg['type'] == 3 or msg['type'] == 10:  # OI or STATS msg
+    # Client will request an id(or may never), thus we can't check for
+    # identity yet
+    process(*args)
+  else:
+    if registry.check_identity(msg['orig_id'], s):
+      process(*args)
+    else:
+      send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+      kill_client(s, "bad_id", sel, registry, pending)
 
-# Returns True if client is an emitter with an associated exhibitor
-def has_exhibitor(client_id, emi_to_exh):
-  return client_id in emi_to_exh
+  stats.routing.add((now() - start) * 1e6)
 
 
-# Check if a socket object and an id point to the same client
-def check_identity(client_id, s, id_to_sock):
-  return id_to_sock[client_id][0] == s
+def process_OK(msg, s, sel, registry, pending):
+  logger.log(logger.TRACE, "recv_ok", "Received OK message with id {} from "
+             "client {}.", msg['id'], msg['orig_id'])
 
+  if s.caps & codec.CAP_CUMULATIVE:
+    # Acknowledges everything the origin sent it up to this message
+    for delivery in pending.resolve_upto(msg['orig_id'], msg['dest_id'],
+                                         msg['id']):
+      finish_delivery(delivery, sel, registry, pending)
+    return
 
-# Process every message received by the server by calling sub process functions
-def process_msg(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  process = {
-    1: process_OK,
-    2: process_ERRO,
-    3: process_OI,
-    4: process_FLW,
-    5: process_MSG,
-    6: process_CREQ
-  }
-
-  args = (msg, s, conn_socks, id_to_sock, emi_to_exh)
-
-  if msg['type'] == 3:  # OI msg
-    # Client will request an id, thus we can't check for identity yet
-    process[msg['type']](*args)
-  else:
-    if check_identity(msg['orig_id'], s, id_to_sock):
-      process[msg['type']](*args)
-    else:
-      send_ERRO(s, serv_id, orig_id, msg_id)
-      kill_client(s, "bad_id", conn_socks, id_to_sock, emi_to_exh)
+  delivery = pending.resolve(msg['orig_id'], msg['dest_id'], msg['id'], True)
+  if delivery:
+    finish_delivery(delivery, sel, registry, pending)
 
 
-def process_OK(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  print("[LOG] Received OK message with id ", msg['id'], " from client ", 
-        msg['orig_id'], ".", sep = "")
+def process_ERRO(msg, s, sel, registry, pending):
+  logger.log(logger.TRACE, "recv_erro", "Received ERRO message with id {} "
+             "from client {}.", msg['id'], msg['orig_id'])
 
+  delivery = pending.resolve(msg['orig_id'], msg['dest_id'], msg['id'], False)
+  if delivery:
+    finish_delivery(delivery, sel, registry, pending)
 
-def process_ERRO(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  print("[LOG] Received ERRO message with id ", msg['id'], " from client ", 
-        msg['orig_id'], ".", sep = "")
 
+def process_OI(msg, s, sel, registry, pending):
+  if registry.id_of(s) is not None:
+    # Connection already has an id. Another one would never be released.
+    logger.log(logger.ERROR, "oi_fail", "Client {} has sent another OI.",
+               registry.id_of(s))
+    send_ERRO(s, serv_id, registry.id_of(s), msg['id'])
+    return
 
-def process_OI(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  client_id = add_client(s, msg['orig_id'], id_to_sock, emi_to_exh)
+  client_id = add_client(s, msg['orig_id'], registry)
   if client_id:
-    # Client was successfully added
-    send_OK(s, serv_id, client_id, msg['id'])
+    # Client was successfully added. The id of OI carries the capabilities it
+    # asks for and the OK answers with the accepted ones.
+    s.caps = msg['id'] & supported_caps
+    if s.caps & codec.CAP_CUMULATIVE:
+      pending.cumulative.add(client_id)
+    send_OK(s, serv_id, client_id, s.caps)
+
+    # Emitters only receive answers to what they send. Stop reading from one
+    # that doesn't consume them.
+    s.throttle = registry.is_emitter(client_id)
 
   else:
     # Some error ocurred when trying to add client
     send_ERRO(s, serv_id, 0, msg['id'])
-    kill_client(s, "oi_fail", conn_socks, id_to_sock, emi_to_exh)
+    kill_client(s, "oi_fail", sel, registry, pending)
 
 
-def process_FLW(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  print("[LOG] Received FLW message from client ", msg['orig_id'], ".", 
-        sep = "")
+def process_FLW(msg, s, sel, registry, pending):
+  logger.log(logger.LOG, "recv_flw", "Received FLW message from client {}.",
+             msg['orig_id'])
 
   # Sends OK to emitter
   send_OK(s, serv_id, msg['orig_id'], msg['id'])
 
-  if has_exhibitor(msg['orig_id'], emi_to_exh):
+  exhibitor_id = registry.unpair(msg['orig_id'])
+  if exhibitor_id is not None:
     # If is emitter and had an exhibitor assigned, request it to die
-    exhibitor_id = emi_to_exh[msg['orig_id']]
-    exhibitor_socket = id_to_sock[exhibitor_id][0]
-
-    print("[LOG] Sending FLW message to client ", exhibitor_id, "(associated e"
-          "xhibitor).", sep = "")
 
-    # Sends FLW to exhibitor
-    msg = create_msg('FLW', serv_id, exhibitor_id, 0)[0]
-    deliver_msg(msg, exhibitor_socket, conn_socks, id_to_sock, emi_to_exh)
+    logger.log(logger.LOG, "send_flw", "Sending FLW message to client {}"
+               "(associated exhibitor).", exhibitor_id)
 
-    # Closes connection to associated exhibitor
-    kill_client(exhibitor_socket, 
-                "flw_msg", 
-                conn_socks, 
-                id_to_sock, 
-                emi_to_exh)
+    # Sends FLW to exhibitor. Its connection is closed once it answers.
+    send_FLW(exhibitor_id, sel, registry, pending)
 
   # Close connection to client(emitter or exhibitor)
-  kill_client(s, "flw_msg", conn_socks, id_to_sock, emi_to_exh)
+  kill_client(s, "flw_msg", sel, registry, pending)
 
 
-def process_MSG(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  # Overhead of recreating the received message
-  fwd_msg = create_msg('MSG', 
-                       msg['orig_id'], 
-                       msg['dest_id'], 
-                       msg['id'], 
-                       msg['msg'])[0]
+def process_MSG(msg, s, sel, registry, pending):
+  # Forward the received frame untouched, straight from the receive buffer
+  fwd_msg = msg['frame']
 
   if msg['dest_id'] == 0:
-    print("[LOG] Client", msg['orig_id'], "has sent a broadcast message.")
+    logger.log(logger.TRACE, "msg", "Client {} has sent a broadcast message.",
+               msg['orig_id'])
   else:
-    print("[LOG] Client ", msg['orig_id'], " has sent a message to client ", 
-          msg['dest_id'], ".", sep = "")
+    logger.log(logger.TRACE, "msg", "Client {} has sent a message to client "
+               "{}.", msg['orig_id'], msg['dest_id'])
   
-  sent = send_to_id(fwd_msg, s, msg, conn_socks, id_to_sock, emi_to_exh)
+  if msg['orig_id'] in streams and msg['id'] in streams[msg['orig_id']]:
+    # Last part of a stream, which goes wherever the rest went
+    end_stream(fwd_msg, s, msg, sel, registry, pending)
+    return
+
+  sent = send_to_id(fwd_msg, s, msg, sel, registry, pending)
   if not sent:
-    # Answer emitter with ERRO
+    # Answer emitter with ERRO. OK is sent when the exhibitors acknowledge.
     send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+
+
+# Forward a compressed message, decompressing it only for the exhibitors that
+# didn't ask for compression
+def process_ZMSG(msg, s, sel, registry, pending):
+  logger.log(logger.TRACE, "msg", "Client {} has sent a compressed message to "
+             "client {}.", msg['orig_id'], msg['dest_id'])
+
+  frames = CompressedFrames(msg, registry)
+  sent = send_to_id(frames, s, msg, sel, registry, pending)
+  if not sent:
+    # Answer emitter with ERRO. OK is sent when the exhibitors acknowledge.
+    send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+
+
+# Relay a fragment of a stream right away, without putting the stream
+# together. The first fragment picks the target, which must be a single
+# exhibitor that asked for streams, or the stream is refused and its final
+# MSG answered with ERRO. The emitter isn't read from while the target is
+# congested, so a stream takes no more memory than its connection buffers.
+def process_FRAG(msg, s, sel, registry, pending):
+  origin = streams.setdefault(msg['orig_id'], {})
+
+  if msg['id'] not in origin:
+    origin[msg['id']] = stream_target(msg['dest_id'], registry)
+    if origin[msg['id']] is None:
+      logger.log(logger.ERROR, "stream", "Stream {} from client {} refused: "
+                 "client {} can't receive it.", msg['id'], msg['orig_id'],
+                 msg['dest_id'])
+    else:
+      logger.log(logger.TRACE, "stream", "Client {} is streaming message {} "
+                 "to client {}.", msg['orig_id'], msg['id'], msg['dest_id'])
+
+  if origin[msg['id']] is None:
+    return
+
+  target_id, conn = origin[msg['id']]
+  if not registry.check_identity(target_id, conn):
+    # Target has disconnected in the meantime
+    origin[msg['id']] = None
+    return
+
+  conn.send(msg['frame'])
+  stats.count_sent(codec.FRAG)
+  if conn.congested:
+    s.wait_for(conn)
+
+
+# Exhibitor a stream to dest_id goes to, as (target_id, connection). None if
+# there is no single exhibitor or it didn't ask for streams.
+def stream_target(dest_id, registry):
+  if registry.is_exhibitor(dest_id):
+    target_id = dest_id
+  elif registry.is_emitter(dest_id):
+    target_id = registry.exhibitor_of(dest_id)
   else:
-    # Answer emitter with OK
-    send_OK(s, serv_id, msg['orig_id'], msg['id'])
+    return None
+
+  if target_id is None or not registry.conn(target_id).caps & codec.CAP_STREAM:
+    return None
+  return target_id, registry.conn(target_id)
+
+
+# Forward the final MSG of a stream to its target, to be acknowledged like
+# any other message
+def end_stream(msg, s, orig_msg, sel, registry, pending):
+  target = streams[orig_msg['orig_id']].pop(orig_msg['id'])
 
+  if target is None or not registry.check_identity(*target):
+    send_ERRO(s, serv_id, orig_msg['orig_id'], orig_msg['id'])
+    return
 
-def process_CREQ(msg, s, conn_socks, id_to_sock, emi_to_exh):
-  clist_payload = create_clist_payload(id_to_sock)
-  clist_msg = create_msg('CLIST', 
-                         msg['orig_id'], 
-                         msg['dest_id'], 
-                         msg['id'], 
-                         clist_payload)[0]
+  delivery = Delivery(s, orig_msg['orig_id'], orig_msg['id'])
+  deliver_msg(msg, [target[0]], delivery, sel, registry, pending)
+
+
+def process_CREQ(msg, s, sel, registry, pending):
+  clist_payload = create_clist_payload(registry)
+  clist_msg = codec.create_msg_parts('CLIST', 
+                                     msg['orig_id'], 
+                                     msg['dest_id'], 
+                                     msg['id'], 
+                                     clist_payload)
 
   if msg['dest_id'] == 0:
-    print("[LOG] Client", msg['orig_id'], "has sent a broadcast CLIST.")
+    logger.log(logger.TRACE, "creq", "Client {} has sent a broadcast CLIST.",
+               msg['orig_id'])
   else:
-    print("[LOG] Client ", msg['orig_id'], " has sent a CLIST to client ", 
-          msg['dest_id'], ".", sep = "")
+    logger.log(logger.TRACE, "creq", "Client {} has sent a CLIST to client "
+               "{}.", msg['orig_id'], msg['dest_id'])
 
-  sent = send_to_id(clist_msg, s, msg, conn_socks, id_to_sock, emi_to_exh)
+  sent = send_to_id(clist_msg, s, msg, sel, registry, pending)
   if not sent:
-    # Answer emitter with ERRO
+    # Answer emitter with ERRO. OK is sent when the exhibitors acknowledge.
     send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
-  else:
-    # Answer emitter with OK
-    send_OK(s, serv_id, msg['orig_id'], msg['id'])
-
-
-# Kill a client connection, removing it from mappings and printing LOG
-def kill_client(s, log, conn_socks, id_to_sock, emi_to_exh):
-  log_msg = {
-    "bad_id": ("[ERROR] Client " + str(get_socket_id(s, id_to_sock)) + " has "
-               "been killed due to bad identity credentials."),
-    "oi_fail": ("[ERROR] Client " + str(get_socket_id(s, id_to_sock)) + " has "
-                "been disconnected due to fail on connection setup."),
-    "flw_msg": ("[LOG] Client " + str(get_socket_id(s, id_to_sock)) + " has "
-                "been disconnected: FLW."),
-    "con_dead": ("[LOG] Client " + str(get_socket_id(s, id_to_sock)) + " has "
-                 "been disconnected.")
-  }
-  
-  print(log_msg[log])
 
-  client_id = get_socket_id(s, id_to_sock)
 
-  if has_exhibitor(client_id, emi_to_exh):
-    # If is emitter and had an exhibitor assigned, request it to die
-    exhibitor_id = emi_to_exh[client_id]
-    exhibitor_socket = id_to_sock[exhibitor_id][0]
+# Split a batch by destination. Records for each exhibitor(including those
+# for the emitter paired with it, broadcasts and multicasts to its groups)
+# are coalesced into a single BMSG, or a run of MSG frames for exhibitors that
+# didn't ask for batches. The emitter is answered with a BACK once every
+# exhibitor has.
+def process_BMSG(msg, s, sel, registry, pending):
+  # Exhibitor of every record, the list of them for broadcasts and multicasts
+  # or None if invalid
+  routes = []
+  batches = {}  # Exhibitor id -> its records
+  fanouts = {}  # Broadcast(0) or group id -> list of its exhibitors
+
+  for dest_id, payload in codec.decode_batch(msg['msg']):
+    if dest_id == 0 or codec.is_group(dest_id):
+      # Broadcast or multicast record
+      if dest_id not in fanouts:
+        if dest_id == 0:
+          fanouts[dest_id] = list(registry.exhibitors())
+        else:
+          fanouts[dest_id] = list(registry.members(dest_id))
+      targets = fanouts[dest_id]
+      routes.append(targets)
+      for target_id in targets:
+        batches.setdefault(target_id, []).append((dest_id, payload))
+      continue
+    elif registry.is_exhibitor(dest_id):
+      targets = [dest_id]
+    elif (registry.is_emitter(dest_id) and
+          registry.exhibitor_of(dest_id) is not None):
+      targets = [registry.exhibitor_of(dest_id)]
+    else:
+      routes.append(None)
+      continue
+
+    routes.append(targets[0])
+    batches.setdefault(targets[0], []).append((dest_id, payload))
+
+  logger.log(logger.TRACE, "batch", "Client {} has sent a batch of {} "
+             "messages to {} exhibitors.", msg['orig_id'], len(routes),
+             len(batches))
+
+  frames = {}
+  answers = {}
+  for target_id, records in batches.items():
+    if registry.conn(target_id).caps & codec.CAP_BATCH:
+      frames[target_id] = create_msg('BMSG', msg['orig_id'], target_id,
+                                     msg['id'], records)[0]
+    else:
+      # A MSG for every record, packed one after the other into a single
+      # buffer. One answer is owed for each.
+      frame = bytearray(sum(codec.msg_header.size + len(payload)
+                            for dest_id, payload in records))
+      offset = 0
+      for dest_id, payload in records:
+        offset = codec.pack_msg_into(frame, offset, msg['orig_id'], dest_id,
+                                     msg['id'], payload)
+      frames[target_id] = frame
+      answers[target_id] = len(records)
+
+  def answer_batch(delivery):
+    statuses = bytearray(len(routes))
+    for i, route in enumerate(routes):
+      if route is None:
+        ok = False
+      elif isinstance(route, list):
+        ok = not delivery.failed_ids.intersection(route)
+      else:
+        ok = route not in delivery.failed_ids
+      statuses[i] = codec.OK if ok else codec.ERRO
+
+    if registry.check_identity(delivery.orig_id, delivery.s):
+      logger.log(logger.TRACE, "send_back", "Sending BACK message to client "
+                 "{}: {} of {} delivered.", delivery.orig_id,
+                 statuses.count(bytearray((codec.OK,))), len(statuses))
+      stats.count_sent(codec.BACK)
+      delivery.s.send(create_msg('BACK', serv_id, delivery.orig_id,
+                                 delivery.msg_id, statuses)[0])
+
+  delivery = Delivery(s, msg['orig_id'], msg['id'], answer_batch)
+  deliver_msg(frames, list(batches), delivery, sel, registry, pending, answers)
+
+
+# Add an exhibitor to the group in dest_id. Answered with ERRO if the client
+# isn't an exhibitor or dest_id isn't the id of a group.
+def process_JOIN(msg, s, sel, registry, pending):
+  if (not registry.is_exhibitor(msg['orig_id']) or
+      not codec.is_group(msg['dest_id'])):
+    send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+    return
 
-    kill_client(exhibitor_socket, log, conn_socks, id_to_sock, emi_to_exh)
+  registry.join(msg['dest_id'], msg['orig_id'])
+  logger.log(logger.LOG, "join", "Exhibitor {} has joined group {}.",
+             msg['orig_id'], msg['dest_id'])
+  send_OK(s, serv_id, msg['orig_id'], msg['id'])
 
-  client_id = get_socket_id(s, id_to_sock)
-  remove_client(client_id, id_to_sock, emi_to_exh)
-  conn_socks.remove(s)
-  s.close()
 
+# Take an exhibitor out of the group in dest_id. Answered with ERRO if it
+# wasn't in it.
+def process_LEAVE(msg, s, sel, registry, pending):
+  if not registry.leave(msg['dest_id'], msg['orig_id']):
+    send_ERRO(s, serv_id, msg['orig_id'], msg['id'])
+    return
 
-# If CTRL+C was received, sends FLW to every client and waits for OK response
-def broadcast_FLW(conn_socks, id_to_sock, emi_to_exh):
-  print("\n[ANNOUNCEMENT] SERVER IS SHUTTING DOWN.")
+  logger.log(logger.LOG, "leave", "Exhibitor {} has left group {}.",
+             msg['orig_id'], msg['dest_id'])
+  send_OK(s, serv_id, msg['orig_id'], msg['id'])
 
-  map_copy = id_to_sock.copy()
-  for client_id in map_copy:
-    client_socket = id_to_sock[client_id][0]
 
-    print("[LOG] Sending FLW message to client ", client_id, ".", sep = "")
-    msg = create_msg('FLW', serv_id, client_id, 0)[0]
-    deliver_msg(msg, client_socket, conn_socks, id_to_sock, emi_to_exh)
+# Answer with the metrics of the server, as JSON. Any connection may ask,
+# whether it has an id or not.
+def process_STATS(msg, s, sel, registry, pending):
+  logger.log(logger.TRACE, "stats", "Client {} has requested the server "
+             "metrics.", msg['orig_id'])
+
+  data = json.dumps(stats.snapshot(registry, pending), sort_keys=True)
+  stats.count_sent(codec.STATS)
+  s.send(create_msg('STATS', serv_id, msg['orig_id'], msg['id'], data)[0])
+
+
+# Send FLW to a client and close its connection once it answers or times out.
+# Returns the delivery waiting for the answer.
+def send_FLW(client_id, sel, registry, pending):
+  client_socket = registry.conn(client_id)
+
+  def close_client(delivery):
+    if not client_socket.closed:
+      kill_client(client_socket, "flw_msg", sel, registry, pending)
+
+  msg = create_msg('FLW', serv_id, client_id, 0)[0]
+  delivery = Delivery(None, serv_id, 0, close_client)
+  deliver_msg(msg, [client_id], delivery, sel, registry, pending)
+  return delivery
+
+
+# Kill a client connection, removing it from mappings and logging why
+def kill_client(s, log, sel, registry, pending):
+  client_id = registry.id_of(s)
+  level, fmt = kill_logs[log]
+  logger.log(level, "kill", fmt, client_id)
+
+  exhibitor_id = registry.exhibitor_of(client_id)
+  if exhibitor_id is not None:
+    # If is emitter and had an exhibitor assigned, request it to die
+    kill_client(registry.conn(exhibitor_id), log, sel, registry, pending)
+
+  if client_id is not None:
+    registry.remove(client_id)
+    streams.pop(client_id, None)
+  s.close()
 
-    remove_client(client_id, id_to_sock, emi_to_exh)
-    conn_socks.remove(client_socket)
-    client_socket.close()
+  if client_id is not None:
+    # Whatever this client still had to acknowledge has failed
+    for delivery in pending.drop_client(client_id):
+      finish_delivery(delivery, sel, registry, pending)
+    if store is not None:
+      # Its id may be given to another client. What was kept for it is lost,
+      # although its emitters were answered OK.
+      for frame in store.discard(client_id):
+        msg_type, orig_id, dest_id, msg_id = codec.decode_header(frame)
+        logger.log(logger.ERROR, "kept_lost", "Kept message {} from client {} "
+                   "was lost: client {} has disconnected.", msg_id, orig_id,
+                   client_id)
+        if orig_id in registry:
+          send_ERRO(registry.conn(orig_id), serv_id, orig_id, msg_id)
+
+
+# Kill the clients whose peer was found gone when writing to them
+def kill_broken(sel, registry, pending):
+  while broken:
+    s = broken.pop()
+    if not s.closed:
+      kill_client(s, "con_dead", sel, registry, pending)
+
+
+# If CTRL+C was received, sends FLW to every client and waits for OK response.
+# All clients are notified at once and their answers are collected as they
+# come, up to the acknowledgement timeout.
+def broadcast_FLW(sel, registry, pending):
+  announce_FLW(sel, registry, pending)
+
+  while len(registry) and len(pending):
+    write_gathered()
+    timeout = pending.next_timeout()
+    for key, mask in sel.select(timeout):
+      s = key.data
+      if s is None or s.closed:
+        # Listening socket, or closed while handling another connection
+        continue
+      if mask & selectors.EVENT_WRITE:
+        s.flush()
+      if not mask & selectors.EVENT_READ:
+        continue
+      if not s.read():
+        kill_client(s, "con_dead", sel, registry, pending)
+        continue
+      for msg in s.frames():
+        if msg['type'] in (1, 2):
+          process_msg(msg, s, sel, registry, pending)
+        if s.closed:
+          break
+    kill_broken(sel, registry, pending)
+    expire_pending(sel, registry, pending)
+    logger.flush()
+
+  kill_all(sel, registry, pending)
+
+
+# Sends FLW to every client. Returns the deliveries waiting for their OK.
+def announce_FLW(sel, registry, pending):
+  logger.log(logger.ANNOUNCEMENT, "shutdown", "SERVER IS SHUTTING DOWN.")
+
+  deliveries = []
+  for client_id in list(registry):
+    logger.log(logger.LOG, "send_flw", "Sending FLW message to client {}.",
+               client_id)
+    deliveries.append(send_FLW(client_id, sel, registry, pending))
+
+  return deliveries
+
+
+# Close the connection of every client still registered
+def kill_all(sel, registry, pending):
+  for client_id in list(registry):
+    if client_id in registry:
+      kill_client(registry.conn(client_id), "flw_msg", sel, registry, pending)
+
+
+# Processing function of every message type the server receives. Built once,
+# and swapped for timed wrappers when profiling.
+handlers = {
+  1: process_OK,
+  2: process_ERRO,
+  3: process_OI,
+  4: process_FLW,
+  5: process_MSG,
+  6: process_CREQ,
+  8: process_BMSG,
+  10: process_STATS,
+  11: process_FRAG,
+  12: process_ZMSG,
+  13: process_JOIN,
+  14: process_LEAVE
+}
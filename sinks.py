@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Exhibitor Output Sinks"""
+
+from __future__ import print_function
+import io
+import sys
+import codecs
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#===================================CLASSES===================================#
+
+# Renders what an exhibitor receives as lines of text, kept until flush writes
+# them all at once. The exhibitor flushes after every batch of messages it
+# reads, so a busy one makes a write per batch instead of one per message.
+#
+# Streamed messages are decoded incrementally, so characters split between
+# fragments still come out whole. The text is written encoded as UTF-8 to a
+# binary file, standard output's underlying buffer by default, since Python 2
+# can't write non ASCII text to a redirected standard output.
+class TextSink(object):
+  def __init__(self, out=None):
+    self.out = out or getattr(sys.stdout, "buffer", sys.stdout)
+    self.lines = []  # Text rendered since the last flush
+    self.decoders = {}  # (orig_id, msg_id) -> decoder of a stream in progress
+
+  def message(self, orig_id, payload):
+    self.lines.append("Message from " + str(orig_id) + ": " +
+                      text(payload) + "\n")
+
+  # Part of a streamed message, the final one if last is set
+  def fragment(self, orig_id, msg_id, chunk, last=False):
+    key = (orig_id, msg_id)
+    if key not in self.decoders:
+      self.decoders[key] = codecs.getincrementaldecoder("utf-8")("replace")
+      self.lines.append("Message from " + str(orig_id) + ": ")
+
+    self.lines.append(self.decoders[key].decode(chunk, last))
+    if last:
+      del self.decoders[key]
+      self.lines.append("\n")
+
+  def clist(self, orig_id, ids):
+    self.lines.append("There are " + str(len(ids)) + " clients connected to "
+                      "the server. These are their ids: " +
+                      ", ".join(str(i) for i in ids) + "\n")
+
+  def flush(self):
+    if self.lines:
+      # Whatever was printed in the meantime goes first
+      sys.stdout.flush()
+      self.out.write("".join(self.lines).encode("utf-8"))
+      self.lines = []
+    self.out.flush()
+
+  def close(self):
+    self.flush()
+
+
+# Text sink that appends to a file
+class FileSink(TextSink):
+  def __init__(self, path):
+    TextSink.__init__(self, io.open(path, "ab"))
+
+  def close(self):
+    TextSink.close(self)
+    self.out.close()
+
+
+# Hands what is received to callback(orig_id, payload, more) instead of
+# rendering it. payload is the content of a message, or a part of it with
+# more set while a stream goes on, or the ids of a CLIST as an array('H').
+class CallbackSink(object):
+  def __init__(self, callback):
+    self.callback = callback
+
+  def message(self, orig_id, payload):
+    self.callback(orig_id, payload, False)
+
+  def fragment(self, orig_id, msg_id, chunk, last=False):
+    self.callback(orig_id, chunk, not last)
+
+  def clist(self, orig_id, ids):
+    self.callback(orig_id, ids, False)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+#===================================METHODS===================================#
+
+# Text of a payload, which is expected to be UTF-8
+def text(payload):
+  return memoryview(payload).tobytes().decode("utf-8", "replace")
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Messaging System Server Store-and-Forward Log"""
+
+from __future__ import print_function
+import os
+import mmap
+import heapq
+import struct
+from collections import deque
+
+__author__ = "João F. Martins, Victor B. Jorge and Alexandre A. Pereira"
+
+#==================================CONSTANTS==================================#
+
+entry = struct.Struct("!HI")  # Target id and size of the frame that follows
+
+segment_size = 2 ** 22  # Bytes of every segment file
+max_bytes = 2 ** 26  # Disk the whole log may take
+
+#===================================CLASSES===================================#
+
+# A fixed size file mapped in memory, where frames are appended one after the
+# other and never changed. Counts the ones still waiting to be delivered, and
+# those handed out that haven't been acknowledged yet.
+class Segment(object):
+  def __init__(self, path, size=segment_size):
+    self.path = path
+    self.f = open(path, "w+b")
+    self.f.truncate(size)
+    self.map = mmap.mmap(self.f.fileno(), size)
+    self.end = 0  # Where the next entry goes
+    self.live = 0  # Entries not delivered yet
+    self.live_bytes = 0  # And their size
+    self.handed = 0  # Live entries handed out for delivery
+
+  # Append a frame for target_id. Returns its offset, None if it doesn't fit.
+  def append(self, target_id, frame):
+    offset = self.end
+    end = offset + entry.size + len(frame)
+    if end > len(self.map):
+      return None
+
+    entry.pack_into(self.map, offset, target_id, len(frame))
+    # Python 2 only takes strings into a map
+    self.map[offset + entry.size:end] = memoryview(frame).tobytes()
+    self.end = end
+    self.live += 1
+    self.live_bytes += end - offset
+    return offset
+
+  # Copy of the frame at offset
+  def read(self, offset):
+    size = entry.unpack_from(self.map, offset)[1]
+    start = offset + entry.size
+    return self.map[start:start + size]
+
+  # Count the entry at offset as delivered
+  def release(self, offset):
+    self.live -= 1
+    self.live_bytes -= entry.size + entry.unpack_from(self.map, offset)[1]
+
+  # Unmap and delete the file
+  def close(self):
+    self.map.close()
+    self.f.close()
+    os.remove(self.path)
+
+
+# Frames kept for targets that can't take them yet, in append-only segments
+# under a directory. Only the last segment is appended to. Once it is full a
+# new one is started, and segments whose frames have all been delivered are
+# deleted.
+#
+# Disk use is bounded by max_bytes. When the log is out of segments, the live
+# frames of the full ones are compacted into as few segments as they need(so
+# for a moment it may take up to twice as much), and if that doesn't free any
+# the frame is refused.
+#
+# The index keeps the (seq, segment, offset) of the frames of each target in
+# the order they were appended, which is the order they are delivered in. A
+# frame handed out with take stays in its segment until it is acknowledged.
+# If its delivery fails it is handed out again before the rest of the index,
+# in the order it was appended. Segments with frames handed out aren't
+# compacted.
+class SegmentLog(object):
+  def __init__(self, directory, max_bytes=max_bytes, size=segment_size):
+    self.directory = directory
+    self.size = size
+    self.max_segments = max(2, max_bytes // size)
+    self.segments = []  # Oldest first, the last one is appended to
+    self.index = {}  # Target id -> deque of (seq, segment, offset)
+    self.retries = {}  # Target id -> heap of the entries to hand out again
+    self.count = 0  # Frames kept, handed out or not
+    self.seq = 0  # Sequence number of the last frame appended
+    self.created = 0  # Segments created so far, for their file names
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def __len__(self):
+    return self.count
+
+  # Returns True if target_id has frames waiting to be handed out
+  def __contains__(self, target_id):
+    return target_id in self.index or target_id in self.retries
+
+  # Ids of the targets with frames waiting to be handed out
+  def targets(self):
+    return list(set(self.index).union(self.retries))
+
+  # Keep a frame for target_id. Returns False if the log is full.
+  def append(self, target_id, frame):
+    if entry.size + len(frame) > self.size:
+      return False
+
+    offset = None
+    if self.segments:
+      offset = self.segments[-1].append(target_id, frame)
+    if offset is None:
+      if not self.rotate():
+        return False
+      offset = self.segments[-1].append(target_id, frame)
+
+    self.seq += 1
+    self.index.setdefault(target_id, deque()).append(
+      (self.seq, self.segments[-1], offset))
+    self.count += 1
+    return True
+
+  # Hand out the oldest frame waiting for target_id. Returns its entry, to be
+  # passed to ack or retry once delivered, and a copy of the frame.
+  def take(self, target_id):
+    retries = self.retries.get(target_id)
+    if retries:
+      entry = heapq.heappop(retries)
+      if not retries:
+        del self.retries[target_id]
+    else:
+      entries = self.index[target_id]
+      entry = entries.popleft()
+      if not entries:
+        del self.index[target_id]
+
+    seq, segment, offset = entry
+    segment.handed += 1
+    return entry, segment.read(offset)
+
+  # Forget a frame that has been delivered
+  def ack(self, entry):
+    entry[1].handed -= 1
+    self.release(entry)
+
+  # Hand a frame whose delivery failed out again, before the ones that were
+  # never handed out
+  def retry(self, target_id, entry):
+    entry[1].handed -= 1
+    heapq.heappush(self.retries.setdefault(target_id, []), entry)
+
+  # Forget every frame waiting for target_id, whose id is about to be given
+  # to another client. Returns copies of them, oldest first.
+  def discard(self, target_id):
+    entries = sorted(self.retries.pop(target_id, []))
+    entries.extend(self.index.pop(target_id, ()))
+
+    frames = []
+    for entry in entries:
+      frames.append(entry[1].read(entry[2]))
+      self.release(entry)
+    return frames
+
+  # Count a frame as gone from its segment
+  def release(self, entry):
+    seq, segment, offset = entry
+    segment.release(offset)
+    self.count -= 1
+    if not segment.live:
+      self.reclaim(segment)
+
+  # Start a new segment to append to, compacting the log if it is out of
+  # segments. Returns False if there is no room left.
+  def rotate(self):
+    if len(self.segments) >= self.max_segments:
+      self.compact()
+      if len(self.segments) >= self.max_segments:
+        return False
+
+    self.segments.append(self.new_segment())
+    return True
+
+  # Move the live frames of the full segments without frames handed out into
+  # fresh ones, packed together, and delete the old ones. Does nothing unless
+  # it frees at least one segment.
+  def compact(self):
+    full = [segment for segment in self.segments[:-1] if not segment.handed]
+    live_bytes = sum(segment.live_bytes for segment in full)
+    if not full or live_bytes > (len(full) - 1) * self.size:
+      return
+
+    full_set = set(full)
+    fresh = []
+
+    def move(target_id, entry):
+      seq, segment, offset = entry
+      if segment not in full_set:
+        return entry
+
+      frame = segment.read(offset)
+      new_offset = fresh[-1].append(target_id, frame) if fresh else None
+      if new_offset is None:
+        fresh.append(self.new_segment())
+        new_offset = fresh[-1].append(target_id, frame)
+      return (seq, fresh[-1], new_offset)
+
+    # Entries keep their order, so the heaps stay heaps
+    for target_id, entries in self.index.items():
+      self.index[target_id] = deque(move(target_id, entry)
+                                    for entry in entries)
+    for target_id, entries in self.retries.items():
+      self.retries[target_id] = [move(target_id, entry) for entry in entries]
+
+    for segment in full:
+      segment.close()
+    self.segments = ([segment for segment in self.segments[:-1]
+                      if segment not in full_set] + fresh +
+                     self.segments[-1:])
+
+  # Delete a segment whose frames have all been delivered. The one being
+  # appended to is kept, starting over from its beginning.
+  def reclaim(self, segment):
+    if segment is self.segments[-1]:
+      segment.end = 0
+      segment.live_bytes = 0
+      return
+
+    self.segments.remove(segment)
+    segment.close()
+
+  def new_segment(self):
+    self.created += 1
+    path = os.path.join(self.directory, "%08d.log" % self.created)
+    return Segment(path, self.size)
+
+  # Delete every segment, with whatever is left in them
+  def close(self):
+    for segment in self.segments:
+      segment.close()
+    self.segments = []
+    self.index.clear()
+    self.retries.clear()
+    self.count = 0